@@ -48,6 +48,10 @@ class Window(pyglet.window.Window):
 		# Which sector the player is currently in.
 		self.sector = None
 
+		# Which chunk the player is currently in, region saves with
+		# loadRadius= load the chunks around it.
+		self.chunk = None
+
 		# The crosshairs at the center of the screen.
 		self.reticle = None
 
@@ -120,6 +124,9 @@ class Window(pyglet.window.Window):
 			elif arg.startswith("fillCavities="):
 				# fill empty space
 				self.blockWork.fillHoles(int(arg.replace("fillCavities=", "")))
+			elif arg.startswith("greedyMesh="):
+				# merge faces of the same material into bigger quads
+				self.model.greedyMesh = bool(int(arg.replace("greedyMesh=", "")))
 		
 		# add timer and bool for the initial loading text while rendereing the world
 		# for the first time
@@ -190,11 +197,19 @@ class Window(pyglet.window.Window):
 
 		"""
 		self.model.process_queue()
+		# progress and end of background saves and exports
+		self.model.saveModule.checkTask(self.model)
+		chunk = chunkize(normalize(self.position))
+		if chunk != self.chunk:
+			# region saves with loadRadius= load the chunks around the player
+			self.model.saveModule.loadChunksNear(self.model, self.position)
+			self.chunk = chunk
 		sector = sectorize(self.position)
 		if sector != self.sector:
 			self.model.change_sectors(self.sector, sector)
 			if self.sector is None:
 				self.model.process_entire_queue()
+				print self.model.mesh_report()
 			self.sector = sector
 		m = 8
 		dt = min(dt, 0.2)
@@ -414,7 +429,8 @@ class Window(pyglet.window.Window):
 		elif symbol == key.F6:
 			#self.model.saveModule.exportOpenScad(self.model)
 			#self.model.saveModule.exportStl(self.model)
-			self.model.saveModule.exportStlZ(self.model)
+			# runs in the background, see saveModule.checkTask
+			self.model.saveModule.exportInBackground(self.model)
 		elif symbol == key.ESCAPE:
 			exit()
 		elif symbol == key.F1:
@@ -552,7 +568,7 @@ class Window(pyglet.window.Window):
 		x, y, z = self.position
 		self.labelDict['worldInfo'].text = '%02d (%.2f, %.2f, %.2f) %d / %d' % (
 			pyglet.clock.get_fps(), x, y, z,
-			len(self.model._shown), len(self.model.world))
+			len(self.model.shown), len(self.model.world))
 		self.labelDict['worldInfo'].draw()
 		
 		if self.renderWorld:
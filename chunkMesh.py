@@ -0,0 +1,194 @@
+""" Meshes of whole chunks.
+
+A chunk is drawn as one indexed vertex list with only the faces between a
+block and empty space, faces between two blocks are never sent to the GPU.
+The mesh is built with numpy from the padded chunk of chunkWorld.getPadded(),
+the border tells if the faces at the edge of the chunk are hidden by the
+next chunk.
+
+The corners of the blocks are on whole numbers relative to the chunk (0 to
+chunkSize), so the vertices are stored as shorts and the chunk is moved to
+its place by a translation, see engine.ChunkGroup. Quads of the same
+material share their corners, every vertex is stored once and the quads
+are drawn by index.
+"""
+import numpy
+
+# the 6 faces in the order of engine.FACES and engine.cube_vertices:
+# top, bottom, left, right, front, back
+FACE_NORMALS = numpy.array([
+	( 0, 1, 0),
+	( 0,-1, 0),
+	(-1, 0, 0),
+	( 1, 0, 0),
+	( 0, 0, 1),
+	( 0, 0,-1),
+])
+
+# the 4 corners of every face, counter clockwise seen from outside, for a
+# block from -1 to 1 on every axis
+FACE_CORNERS = numpy.array([
+	[(-1, 1,-1), (-1, 1, 1), ( 1, 1, 1), ( 1, 1,-1)],
+	[(-1,-1,-1), ( 1,-1,-1), ( 1,-1, 1), (-1,-1, 1)],
+	[(-1,-1,-1), (-1,-1, 1), (-1, 1, 1), (-1, 1,-1)],
+	[( 1,-1, 1), ( 1,-1,-1), ( 1, 1,-1), ( 1, 1, 1)],
+	[(-1,-1, 1), ( 1,-1, 1), ( 1, 1, 1), (-1, 1, 1)],
+	[( 1,-1,-1), (-1,-1,-1), (-1, 1,-1), ( 1, 1,-1)],
+])
+
+# materials side by side in texture.png, see engine.tex_coord
+TEXTURE_TILES = 200
+
+# pyglet formats of the mesh and their size in bytes
+VERTEX_FORMAT = 'v3s/static'
+TEX_COORD_FORMAT = 't2f/static'
+VERTEX_BYTES = 3 * 2 + 2 * 4
+INDEX_BYTES = 4
+# the old mesh: 24 vertices per shown block, v3f and t2f, no index
+BLOCK_BYTES_UNINDEXED = 24 * (3 * 4 + 2 * 4)
+
+
+def getFaceMaterials(padded):
+	""" Yields (face index, array) for the 6 faces, the array of the chunk
+	has the material + 1 of every block with this face next to empty space,
+	0 everywhere else.
+	"""
+	inner = padded.shape[0] - 2
+	core = padded[1:-1, 1:-1, 1:-1]
+	for face, (dx, dy, dz) in enumerate(FACE_NORMALS.tolist()):
+		neighbor = padded[1 + dx:1 + dx + inner, 1 + dy:1 + dy + inner, 1 + dz:1 + dz + inner]
+		yield face, numpy.where(neighbor == 0, core, 0)
+
+
+def getVisibleFaces(padded):
+	""" Yields (face index, xs, ys, zs) of the block faces next to empty
+	space, in chunk coordinates.
+	"""
+	for face, materials in getFaceMaterials(padded):
+		xs, ys, zs = numpy.nonzero(materials)
+		if len(xs):
+			yield face, xs, ys, zs
+
+
+def indexQuads(corners, materials, chunkSize):
+	""" Returns the mesh of the quads as flat arrays: vertices (int16, x, y,
+	z relative to the chunk), texture coordinates (float32, u, v) and the
+	indices (uint32, 4 per quad) into them. Corners of the same material
+	become one vertex.
+
+	Parameters
+	----------
+	corners : numpy array of shape (n, 4, 3)
+		The corners of n quads, whole numbers from 0 to chunkSize.
+	materials : numpy array of len n
+		The material + 1 of every quad.
+	chunkSize : int
+		Blocks per chunk on every axis.
+
+	"""
+	if not len(corners):
+		return numpy.zeros(0, dtype=numpy.int16), numpy.zeros(0, dtype=numpy.float32), numpy.zeros(0, dtype=numpy.uint32)
+	side = chunkSize + 1
+	corners = corners.reshape(-1, 3).astype(numpy.int64)
+	keys = ((corners[:, 0] * side + corners[:, 1]) * side + corners[:, 2]) * 256 + numpy.repeat(materials, 4)
+	keys, indices = numpy.unique(keys, return_inverse=True)
+
+	vertices = numpy.column_stack((keys // 256 // side // side, keys // 256 // side % side, keys // 256 % side))
+	# every material is a single texel, all corners use its center
+	tile = 1.0 / TEXTURE_TILES
+	texCoords = numpy.zeros((len(keys), 2), dtype=numpy.float32)
+	texCoords[:, 0] = (keys % 256 - 0.5) * tile
+	texCoords[:, 1] = 0.5 * tile
+	return vertices.reshape(-1).astype(numpy.int16), texCoords.reshape(-1), indices.astype(numpy.uint32)
+
+
+def buildMesh(padded):
+	""" Returns the indexed mesh of a chunk with one quad per visible face,
+	see indexQuads.
+
+	Parameters
+	----------
+	padded : numpy array
+		The chunk with a border of one block, see chunkWorld.getPadded.
+
+	"""
+	corners = []
+	materials = []
+	core = padded[1:-1, 1:-1, 1:-1]
+	for face, xs, ys, zs in getVisibleFaces(padded):
+		blocks = numpy.column_stack((xs, ys, zs))
+		# a corner at -1 is the low side of the block, at 1 the high side
+		corners.append(blocks[:, None, :] + (FACE_CORNERS[face] > 0))
+		materials.append(core[xs, ys, zs])
+	if not corners:
+		return indexQuads([], [], padded.shape[0] - 2)
+	return indexQuads(numpy.concatenate(corners), numpy.concatenate(materials), padded.shape[0] - 2)
+
+
+def mergePlane(plane):
+	""" Greedy merge of one layer of faces: returns (i0, j0, i1, j1,
+	material + 1) rectangles, all inclusive, that cover the faces of the 2D
+	list `plane` (0 is no face). Faces are merged along j first, then the
+	rectangle grows along i as long as whole rows match.
+	"""
+	rects = []
+	rows = len(plane)
+	for i in xrange(rows):
+		row = plane[i]
+		j = 0
+		columns = len(row)
+		while j < columns:
+			material = row[j]
+			if not material:
+				j += 1
+				continue
+			end = j + 1
+			while end < columns and row[end] == material:
+				end += 1
+			run = [material] * (end - j)
+			last = i
+			while last + 1 < rows and plane[last + 1][j:end] == run:
+				last += 1
+			empty = [0] * (end - j)
+			for k in xrange(i, last + 1):
+				plane[k][j:end] = empty
+			rects.append((i, j, last, end - 1, material))
+			j = end
+	return rects
+
+
+def buildGreedyMesh(padded):
+	""" Same as buildMesh, but neighboring faces of the same material in
+	the same plane are merged into one bigger quad.
+
+	Every material is a single texel of texture.png, so a merged quad shows
+	the same color as the single faces, no matter how big it is.
+
+	"""
+	lows = []
+	highs = []
+	faces = []
+	materials = []
+	for face, faceMaterials in getFaceMaterials(padded):
+		axis = int(numpy.flatnonzero(FACE_NORMALS[face])[0])
+		# the other two axes span the plane, in ascending order
+		planeAxes = [other for other in xrange(3) if other != axis]
+		for layer in numpy.flatnonzero(faceMaterials.any(axis=tuple(planeAxes))).tolist():
+			plane = numpy.take(faceMaterials, layer, axis=axis).tolist()
+			for i0, j0, i1, j1, material in mergePlane(plane):
+				low = [layer] * 3
+				high = [layer] * 3
+				low[planeAxes[0]], high[planeAxes[0]] = i0, i1
+				low[planeAxes[1]], high[planeAxes[1]] = j0, j1
+				lows.append(low)
+				highs.append(high)
+				faces.append(face)
+				materials.append(material)
+	if not faces:
+		return indexQuads([], [], padded.shape[0] - 2)
+
+	lows = numpy.array(lows)
+	highs = numpy.array(highs)
+	# a corner at -1 is on the low side of the first block, at 1 on the high side of the last one
+	corners = numpy.where(FACE_CORNERS[faces] < 0, lows[:, None, :], highs[:, None, :] + 1)
+	return indexQuads(corners, numpy.array(materials), padded.shape[0] - 2)
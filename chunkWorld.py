@@ -0,0 +1,493 @@
+""" World storage in dense chunks.
+
+chunkWorld keeps the blocks in numpy arrays of chunkSize blocks on every axis,
+one uint8 per block: material + 1, 0 is empty. It is used like the old
+{(x, y, z): material} dict of `Model.world` but needs about a byte per block
+and neighbor lookups are array indexing.
+
+mmapWorld keeps the chunks in files that are memory mapped when they are
+used, for scans that do not fit into memory. Only the last used chunks stay
+mapped (LRU), the OS writes the others back to the disk:
+
+	python DICraft.py savefile=big.sav mmapWorld=/scratch/dicraft
+"""
+import os
+import glob
+import collections
+import threading
+import itertools
+import numpy
+
+CHUNK_FILE = "%d_%d_%d.chunk"
+
+
+def groupByChunk(positions, chunkSize):
+	""" Yields (chunk, indices of the positions in the chunk) for an
+	(n, 3) array of block positions.
+	"""
+	if not len(positions):
+		return
+	chunks = positions // chunkSize
+	# one sort key per chunk instead of a lexsort over x, y, z
+	offset = chunks - chunks.min(axis=0)
+	dims = offset.max(axis=0) + 1
+	keys = (offset[:, 0] * dims[1] + offset[:, 1]) * dims[2] + offset[:, 2]
+	# stable, the last of several equal positions wins like in a dict
+	order = numpy.argsort(keys, kind="mergesort")
+	keys = keys[order]
+	starts = [0] + (numpy.flatnonzero(keys[1:] != keys[:-1]) + 1).tolist()
+	ends = starts[1:] + [len(order)]
+	for start, end in itertools.izip(starts, ends):
+		yield tuple(chunks[order[start]].tolist()), order[start:end]
+
+
+class chunkWorld(collections.MutableMapping):
+	""" {(x, y, z): material} stored in dense chunks in memory.
+
+	Parameters
+	----------
+	chunkSize : int
+		Blocks per chunk on every axis.
+	"""
+	def __init__(self, chunkSize=32):
+		self.chunkSize = chunkSize
+		# blocks in every stored chunk
+		self.counts = {}
+		self.count = 0
+		# chunk: uint8 array
+		self.chunks = {}
+
+	def getChunk(self, chunk, create=False):
+		""" Returns the array of a chunk, None if it has no blocks and
+		`create` is not set.
+		"""
+		array = self.chunks.get(chunk)
+		if array is None and create:
+			array = self.chunks[chunk] = numpy.zeros((self.chunkSize,) * 3, dtype=numpy.uint8)
+			self.counts[chunk] = 0
+		return array
+
+	def dropChunk(self, chunk):
+		""" Forgets a chunk without blocks.
+		"""
+		del self.chunks[chunk]
+		del self.counts[chunk]
+
+	def getChunks(self):
+		""" Returns the chunks with blocks.
+		"""
+		return self.counts.keys()
+
+	def copy(self):
+		""" Returns a chunkWorld in memory with copies of all chunks.
+		"""
+		world = chunkWorld(self.chunkSize)
+		for chunk in self.counts:
+			world.chunks[chunk] = numpy.array(self.getChunk(chunk))
+		world.counts = dict(self.counts)
+		world.count = self.count
+		return world
+
+	def snapshot(self):
+		""" Returns a world that keeps the blocks as they are now, for a
+		save in a background thread.
+		"""
+		return self.copy()
+
+	def beforeWrite(self, chunk):
+		""" Called before a chunk changes.
+		"""
+		pass
+
+	def split(self, position):
+		x, y, z = position
+		size = self.chunkSize
+		return (x // size, y // size, z // size), (x % size, y % size, z % size)
+
+	def __getitem__(self, position):
+		chunk, local = self.split(position)
+		array = self.getChunk(chunk)
+		if array is None or not array.item(local):
+			raise KeyError(position)
+		return array.item(local) - 1
+
+	def __contains__(self, position):
+		chunk, local = self.split(position)
+		if not chunk in self.counts:
+			return False
+		return bool(self.getChunk(chunk).item(local))
+
+	def __setitem__(self, position, material):
+		chunk, local = self.split(position)
+		self.beforeWrite(chunk)
+		array = self.getChunk(chunk, True)
+		if not array.item(local):
+			self.counts[chunk] += 1
+			self.count += 1
+		array[local] = material + 1
+
+	def __delitem__(self, position):
+		chunk, local = self.split(position)
+		array = self.getChunk(chunk)
+		if array is None or not array.item(local):
+			raise KeyError(position)
+		self.beforeWrite(chunk)
+		array[local] = 0
+		self.counts[chunk] -= 1
+		self.count -= 1
+		if not self.counts[chunk]:
+			self.dropChunk(chunk)
+
+	def __len__(self):
+		return self.count
+
+	def exposed(self, position):
+		""" Returns True if one of the 6 neighbors of `position` is empty.
+		"""
+		chunk, (lx, ly, lz) = self.split(position)
+		last = self.chunkSize - 1
+		array = self.getChunk(chunk)
+		if array is not None and 0 < lx < last and 0 < ly < last and 0 < lz < last:
+			# all neighbors in the same chunk
+			item = array.item
+			return not (item(lx - 1, ly, lz) and item(lx + 1, ly, lz) and item(lx, ly - 1, lz) and
+				item(lx, ly + 1, lz) and item(lx, ly, lz - 1) and item(lx, ly, lz + 1))
+		x, y, z = position
+		return not ((x - 1, y, z) in self and (x + 1, y, z) in self and (x, y - 1, z) in self and
+			(x, y + 1, z) in self and (x, y, z - 1) in self and (x, y, z + 1) in self)
+
+	def iterChunks(self):
+		""" Yields (positions as (n, 3) array, materials) chunk by chunk.
+		"""
+		for chunk in sorted(self.counts):
+			array = self.getChunk(chunk)
+			xs, ys, zs = numpy.nonzero(array)
+			materials = array[xs, ys, zs].astype(numpy.int64) - 1
+			positions = numpy.column_stack((xs, ys, zs)) + numpy.array(chunk) * self.chunkSize
+			yield positions, materials
+
+	def __iter__(self):
+		for positions, materials in self.iterChunks():
+			for position in itertools.izip(*positions.T.tolist()):
+				yield position
+
+	def itervalues(self):
+		for positions, materials in self.iterChunks():
+			for material in materials.tolist():
+				yield material
+
+	def iteritems(self):
+		for positions, materials in self.iterChunks():
+			for item in itertools.izip(itertools.izip(*positions.T.tolist()), materials.tolist()):
+				yield item
+
+	def getChunkPositions(self, chunk):
+		""" Returns the positions of the blocks in a chunk.
+		"""
+		if not chunk in self.counts:
+			return []
+		xs, ys, zs = numpy.nonzero(self.getChunk(chunk))
+		cx, cy, cz = [value * self.chunkSize for value in chunk]
+		return zip((xs + cx).tolist(), (ys + cy).tolist(), (zs + cz).tolist())
+
+	def getPadded(self, chunk):
+		""" Returns the materials + 1 of a chunk with a border of one block
+		on every side, taken from the 6 neighbor chunks.
+		"""
+		size = self.chunkSize
+		padded = numpy.zeros((size + 2,) * 3, dtype=numpy.uint8)
+		array = self.getChunk(chunk)
+		if array is None:
+			return padded
+		padded[1:-1, 1:-1, 1:-1] = array
+		for axis in xrange(3):
+			# the last layer of the chunk before, the first one of the chunk after
+			for step, source, target in ((-1, -1, 0), (1, 0, -1)):
+				neighborChunk = list(chunk)
+				neighborChunk[axis] += step
+				neighbor = self.getChunk(tuple(neighborChunk))
+				if neighbor is None:
+					continue
+				sourceIndex = [slice(None)] * 3
+				sourceIndex[axis] = source
+				targetIndex = [slice(1, -1)] * 3
+				targetIndex[axis] = target
+				padded[tuple(targetIndex)] = neighbor[tuple(sourceIndex)]
+		return padded
+
+	def getExposed(self, chunk, padded=None):
+		""" Returns a bool array of the chunk, True for every block with at
+		least one empty neighbor. Six shifted compares of the padded chunk
+		instead of six lookups per block.
+		"""
+		if padded is None:
+			padded = self.getPadded(chunk)
+		solid = padded > 0
+		covered = (solid[:-2, 1:-1, 1:-1] & solid[2:, 1:-1, 1:-1] &
+			solid[1:-1, :-2, 1:-1] & solid[1:-1, 2:, 1:-1] &
+			solid[1:-1, 1:-1, :-2] & solid[1:-1, 1:-1, 2:])
+		return solid[1:-1, 1:-1, 1:-1] & ~covered
+
+	def getExposedBlocks(self, chunk, padded=None):
+		""" Returns [(position, material)] of the exposed blocks of a chunk.
+		"""
+		if not chunk in self.counts:
+			return []
+		if padded is None:
+			padded = self.getPadded(chunk)
+		xs, ys, zs = numpy.nonzero(self.getExposed(chunk, padded))
+		materials = (padded[xs + 1, ys + 1, zs + 1].astype(numpy.int64) - 1).tolist()
+		cx, cy, cz = [value * self.chunkSize for value in chunk]
+		return zip(zip((xs + cx).tolist(), (ys + cy).tolist(), (zs + cz).tolist()), materials)
+
+	def getChunkBlocks(self, chunk):
+		""" Returns {position: material} of the blocks in a chunk.
+		"""
+		if not chunk in self.counts:
+			return {}
+		array = self.getChunk(chunk)
+		xs, ys, zs = numpy.nonzero(array)
+		materials = (array[xs, ys, zs].astype(numpy.int64) - 1).tolist()
+		cx, cy, cz = [value * self.chunkSize for value in chunk]
+		return dict(itertools.izip(itertools.izip((xs + cx).tolist(), (ys + cy).tolist(), (zs + cz).tolist()), materials))
+
+	def findBlocks(self, positions):
+		""" Returns a bool array, True for every position of the (n, 3)
+		array that has a block.
+		"""
+		found = numpy.zeros(len(positions), dtype=bool)
+		for chunk, indices in groupByChunk(positions, self.chunkSize):
+			if chunk in self.counts:
+				local = positions[indices] % self.chunkSize
+				found[indices] = self.getChunk(chunk)[local[:, 0], local[:, 1], local[:, 2]] > 0
+		return found
+
+	def setBlocks(self, positions, materials):
+		""" Sets the materials of many blocks at once, chunk by chunk.
+		"""
+		for chunk, indices in groupByChunk(positions, self.chunkSize):
+			self.beforeWrite(chunk)
+			array = self.getChunk(chunk, True)
+			local = positions[indices] % self.chunkSize
+			before = self.counts[chunk]
+			array[local[:, 0], local[:, 1], local[:, 2]] = materials[indices] + 1
+			self.counts[chunk] = int(numpy.count_nonzero(array))
+			self.count += self.counts[chunk] - before
+
+	def setRuns(self, runs):
+		""" Sets the blocks of columns (x, y0, z, y1, material), y0 to y1
+		inclusive, chunk by chunk. Only one column piece per chunk is
+		expanded at a time. Returns the chunks that changed.
+		"""
+		size = self.chunkSize
+		xs, y0s, zs, y1s, materials = runs.T
+		# split the columns at the chunk borders
+		first = y0s // size
+		pieces = y1s // size - first + 1
+		runIndex = numpy.repeat(numpy.arange(len(runs)), pieces)
+		chunkYs = numpy.arange(len(runIndex)) - numpy.repeat(numpy.cumsum(pieces) - pieces, pieces) + first[runIndex]
+		bottoms = numpy.maximum(y0s[runIndex], chunkYs * size)
+		tops = numpy.minimum(y1s[runIndex], chunkYs * size + size - 1)
+		starts = numpy.column_stack((xs[runIndex], bottoms, zs[runIndex]))
+		ys = numpy.arange(size)
+		chunks = []
+		for chunk, indices in groupByChunk(starts, size):
+			self.beforeWrite(chunk)
+			array = self.getChunk(chunk, True)
+			local = starts[indices] % size
+			inside = (ys >= local[:, 1, None]) & (ys <= (tops[indices] % size)[:, None])
+			piece, y = numpy.nonzero(inside)
+			before = self.counts[chunk]
+			array[local[piece, 0], y, local[piece, 2]] = materials[runIndex[indices[piece]]] + 1
+			self.counts[chunk] = int(numpy.count_nonzero(array))
+			self.count += self.counts[chunk] - before
+			chunks.append(chunk)
+		return chunks
+
+	def getColumns(self):
+		""" Returns the (x, z) columns with blocks.
+		"""
+		columns = set()
+		for chunk in self.counts:
+			xs, zs = numpy.nonzero(self.getChunk(chunk).any(axis=1))
+			cx, cy, cz = chunk
+			columns.update(itertools.izip((xs + cx * self.chunkSize).tolist(), (zs + cz * self.chunkSize).tolist()))
+		return columns
+
+	def getColumnRuns(self, columns):
+		""" Yields (x, y0, z, y1) for every run of blocks on top of each
+		other in the given (x, z) columns.
+		"""
+		size = self.chunkSize
+		stacks = collections.defaultdict(list)
+		for cx, cy, cz in self.counts:
+			stacks[cx, cz].append(cy)
+		for x, z in columns:
+			(cx, lx), (cz, lz) = divmod(x, size), divmod(z, size)
+			chunkYs = sorted(stacks.get((cx, cz), ()))
+			if not chunkYs:
+				continue
+			column = numpy.zeros((chunkYs[-1] - chunkYs[0] + 1) * size + 2, dtype=numpy.int8)
+			for cy in chunkYs:
+				start = (cy - chunkYs[0]) * size + 1
+				column[start:start + size] = self.getChunk((cx, cy, cz))[lx, :, lz] > 0
+			# 1 where a run starts, -1 after its end
+			edges = numpy.flatnonzero(numpy.diff(column))
+			bottom = chunkYs[0] * size
+			for start, end in itertools.izip(edges[::2].tolist(), edges[1::2].tolist()):
+				yield x, bottom + start, z, bottom + end - 1
+
+
+class mmapWorld(chunkWorld):
+	""" {(x, y, z): material} stored in memory mapped chunk files.
+
+	Parameters
+	----------
+	folder : string
+		Folder for the chunk files, created if needed. It is scratch space,
+		chunk files from an earlier run are removed.
+	chunkSize : int
+		Blocks per chunk on every axis.
+	cacheSize : int
+		Number of chunks kept mapped at the same time.
+	"""
+	def __init__(self, folder, chunkSize=32, cacheSize=256):
+		chunkWorld.__init__(self, chunkSize)
+		self.folder = folder
+		self.cacheSize = cacheSize
+		# chunk: memmap, the last used at the end
+		self.cache = collections.OrderedDict()
+		# the editor and a save in a background thread use the world at the same time
+		self.lock = threading.RLock()
+		# mmapSnapshots that keep the chunks as they were, see beforeWrite
+		self.snapshots = []
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		for path in glob.glob(os.path.join(folder, "*.chunk")):
+			os.remove(path)
+
+	def getChunkPath(self, chunk):
+		return os.path.join(self.folder, CHUNK_FILE % chunk)
+
+	def getChunk(self, chunk, create=False):
+		""" Returns the mapped array of a chunk, None if it has no blocks
+		and `create` is not set.
+		"""
+		with self.lock:
+			array = self.cache.pop(chunk, None)
+			if array is None:
+				if chunk in self.counts:
+					array = numpy.memmap(self.getChunkPath(chunk), dtype=numpy.uint8, mode="r+", shape=(self.chunkSize,) * 3)
+				elif create:
+					array = numpy.memmap(self.getChunkPath(chunk), dtype=numpy.uint8, mode="w+", shape=(self.chunkSize,) * 3)
+					self.counts[chunk] = 0
+				else:
+					return None
+				if len(self.cache) >= self.cacheSize:
+					# unmap the least recently used chunk, the OS writes it back
+					self.cache.popitem(last=False)
+			self.cache[chunk] = array
+			return array
+
+	def dropChunk(self, chunk):
+		""" Forgets a chunk without blocks, its file (all zeros) stays.
+		"""
+		with self.lock:
+			self.cache.pop(chunk, None)
+			del self.counts[chunk]
+
+	def beforeWrite(self, chunk):
+		""" Called before a chunk changes, the snapshots copy it first.
+		"""
+		for snapshot in self.snapshots:
+			snapshot.preserve(chunk)
+
+	def __setitem__(self, position, material):
+		with self.lock:
+			chunkWorld.__setitem__(self, position, material)
+
+	def __delitem__(self, position):
+		with self.lock:
+			chunkWorld.__delitem__(self, position)
+
+	def setBlocks(self, positions, materials):
+		with self.lock:
+			chunkWorld.setBlocks(self, positions, materials)
+
+	def setRuns(self, runs):
+		with self.lock:
+			return chunkWorld.setRuns(self, runs)
+
+	def flush(self):
+		with self.lock:
+			for array in self.cache.itervalues():
+				array.flush()
+
+	def snapshot(self):
+		return mmapSnapshot(self)
+
+
+class mmapSnapshot(chunkWorld):
+	""" Read only view of an mmapWorld as it was when the snapshot was
+	taken, for a save in a background thread while the editor goes on.
+	The world hands a chunk to the snapshot before it changes it for the
+	first time (copy on write), so only the changed chunks are copied into
+	memory. `release` detaches the snapshot from the world.
+
+	Parameters
+	----------
+	world : mmapWorld
+	cacheSize : int
+		Number of unchanged chunks the snapshot keeps copies of.
+	"""
+	def __init__(self, world, cacheSize=16):
+		self.world = world
+		self.chunkSize = world.chunkSize
+		self.cacheSize = cacheSize
+		# copies of unchanged chunks, the last used at the end
+		self.cache = collections.OrderedDict()
+		with world.lock:
+			self.counts = dict(world.counts)
+			self.count = world.count
+			# chunk: its blocks when the snapshot was taken
+			self.saved = {}
+			world.snapshots.append(self)
+
+	def preserve(self, chunk):
+		""" Called by the world (holding its lock) before `chunk` changes.
+		"""
+		if chunk in self.counts and not chunk in self.saved:
+			array = self.cache.pop(chunk, None)
+			if array is None:
+				array = numpy.array(self.world.getChunk(chunk))
+			self.saved[chunk] = array
+
+	def getChunk(self, chunk, create=False):
+		if not chunk in self.counts:
+			return None
+		with self.world.lock:
+			if chunk in self.saved:
+				return self.saved[chunk]
+			array = self.cache.pop(chunk, None)
+			if array is None:
+				# a copy, the editor may change the mapped chunk while it is read
+				array = numpy.array(self.world.getChunk(chunk))
+				if len(self.cache) >= self.cacheSize:
+					self.cache.popitem(last=False)
+			self.cache[chunk] = array
+			return array
+
+	def release(self):
+		with self.world.lock:
+			if self in self.world.snapshots:
+				self.world.snapshots.remove(self)
+		self.saved = {}
+		self.cache.clear()
+
+	def readOnly(self, *args):
+		raise TypeError("a snapshot of the world is read only")
+
+	__setitem__ = __delitem__ = setBlocks = setRuns = dropChunk = readOnly
+
+	def snapshot(self):
+		return self
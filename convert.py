@@ -1,7 +1,12 @@
 import sys
 import os
+import json
+import hashlib
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import dicom
+import dicomIndex
 
 formats = {".png":"+on", ".pgm":"+opw", ".pnm":"+op"}
 
@@ -9,36 +14,132 @@ dcmFilePath = "./multiImageTest"
 destPath = "./tmp"
 destFormat = ".pnm"
 dcmFiles = []
-clearTemp = True
+# remove ALL converted files first, otherwise only new or changed files are converted
+clearTemp = False
+# number of dcmj2pnm processes running at once
+jobs = multiprocessing.cpu_count()
+# source file, size, mtime and content hash of every converted file, kept in the destination folder
+manifestName = "convert.manifest"
+
 if len(sys.argv) > 1:
 	dcmFilePath = sys.argv[1]
 
 if len(sys.argv) > 2:
 	destPath = sys.argv[2]
-	
-dcmFilesTmp = os.listdir(dcmFilePath)
-dcmFilesTmp.sort()
+
+for arg in sys.argv:
+	if arg.startswith("jobs="):
+		jobs = max(1, int(arg.replace("jobs=", "")))
+	elif arg.startswith("clear="):
+		clearTemp = bool(int(arg.replace("clear=", "")))
+
+def fileHash(path):
+	md5 = hashlib.md5()
+	fh = open(path, 'rb')
+	for block in iter(lambda: fh.read(1024 * 1024), b''):
+		md5.update(block)
+	fh.close()
+	return md5.hexdigest()
+
+def sourceEntry(source, frame):
+	""" the manifest entry of an output: which file (and frame) it was
+	converted from and the size, mtime and content hash of that file
+	"""
+	stat = os.stat(source)
+	return {"source":os.path.abspath(source), "frame":frame, "size":stat.st_size, "mtime":stat.st_mtime,
+		"md5":fileHash(source)}
+
+def isUpToDate(fileInfo, manifest):
+	""" True if the output of the given file exists and the manifest says
+	it was converted from this very file, which did not change since
+
+	Outputs of another study (tmp/ is kept between runs and the file names
+	repeat, IM0001...) are never reused. An unchanged size and mtime is
+	enough, otherwise the content hash decides and the new mtime is kept.
+	"""
+	source, dest, name, frame = fileInfo
+	entry = manifest.get(os.path.basename(dest))
+	if not os.path.exists(dest) or not isinstance(entry, dict):
+		return False
+	if entry.get("source") != os.path.abspath(source) or entry.get("frame") != frame:
+		return False
+	stat = os.stat(source)
+	if entry.get("size") != stat.st_size:
+		return False
+	if entry.get("mtime") == stat.st_mtime:
+		return True
+	if entry.get("md5") != fileHash(source):
+		return False
+	entry["mtime"] = stat.st_mtime
+	return True
+
+def convertFile(fileInfo):
+	source, dest, name, frame = fileInfo
+	entry = sourceEntry(source, frame)
+	options = [formats[destFormat]]
+	if frame is not None:
+		# dcmj2pnm only decodes the selected frame of a multi-frame file
+		options += ["+F", str(frame + 1)]
+	# write to a temporary name, an aborted run must not leave a complete looking file
+	subprocess.check_output(["dcmj2pnm"] + options + [source, dest + ".part"])
+	if os.path.exists(dest):
+		os.remove(dest)
+	os.rename(dest + ".part", dest)
+	return os.path.basename(dest), entry
+
+manifestPath = os.path.join(destPath, manifestName)
+manifest = {}
+if os.path.exists(manifestPath):
+	fh = open(manifestPath, 'r')
+	manifest = json.load(fh)
+	fh.close()
+
+# outputs of an aborted run, never complete
+for fil in os.listdir(destPath):
+	if fil.endswith(".part"):
+		os.remove(os.path.join(destPath, fil))
 
 if clearTemp:
 	cntRemoved = 0
-	for fil in os.listdir("tmp"):
+	for fil in os.listdir(destPath):
 		if not fil.endswith(".md"):
-			#print os.path.join("tmp", fil)
-			os.remove(os.path.join("tmp", fil))
+			#print os.path.join(destPath, fil)
+			os.remove(os.path.join(destPath, fil))
+			cntRemoved += 1
+	manifest = {}
 	print "removed", cntRemoved, "files"
 
+# all DICOM images in slice order, the headers tell what is a DICOM file and where the slice is,
+# every frame of a multi-frame file becomes a slice file of its own
+for source in dicomIndex.getSortedFrames(dcmFilePath):
+	frame = None
+	if isinstance(source, tuple):
+		source, frame = source
+		name = "%s.%04d" % (os.path.basename(source), frame)
+	else:
+		name = os.path.basename(source)
+	dcmFiles.append([source, os.path.join(destPath, name + destFormat), name, frame])
 
-for i in range(len(dcmFilesTmp)):
-	if dcmFilesTmp[i].lower().endswith(".dcm"):
-		#dcm = dicom.load()
-		dcmFiles.append( [os.path.join(dcmFilePath, dcmFilesTmp[i]), dcmFilesTmp[i]])
+# dcm2save.py converts the slices in this order
+fh = open(os.path.join(destPath, "slices.order"), 'w')
+fh.write("\n".join(os.path.basename(fileInfo[1]) for fileInfo in dcmFiles))
+fh.close()
 
-cntCurrentFile = 0
-totalFiles = len(dcmFiles)
-for fileInfo in dcmFiles:
-	# TODO: if dcmj2pnm does not exist
-	# OSError: [Errno 2] No such file or directory
-	cntCurrentFile += 1
-	print cntCurrentFile, "/", totalFiles
-	output = subprocess.check_output(["dcmj2pnm", formats[destFormat], fileInfo[0], os.path.join(destPath, fileInfo[1] + destFormat)])
+toConvert = [fileInfo for fileInfo in dcmFiles if not isUpToDate(fileInfo, manifest)]
+print len(dcmFiles) - len(toConvert), "files up to date,", len(toConvert), "to convert"
 
+cntCurrentFile = 0
+totalFiles = len(toConvert)
+pool = ThreadPool(jobs)
+try:
+	for output, entry in pool.imap_unordered(convertFile, toConvert):
+		cntCurrentFile += 1
+		manifest[output] = entry
+		print cntCurrentFile, "/", totalFiles, output
+except OSError:
+	print "dcmj2pnm not found, it is part of the dcmtk"
+finally:
+	pool.close()
+	fh = open(manifestPath, 'w')
+	json.dump(manifest, fh, indent=0, sort_keys=True)
+	fh.close()
@@ -1,11 +1,18 @@
 #!/usr/bin/python
 
 import sys, os
+import zlib
+import multiprocessing
+from collections import deque
 import numpy
 import dicom
 import pnmHeader
 import saveModule
 import multiTimer
+import thresholdEngine
+import histogram
+import pyramid
+import dicomIndex
 
 
 minVal = 1 #12850
@@ -17,6 +24,34 @@ materialMatrixL = 99 #len(materialMatrix)
 
 # heightMap
 heightMap = False
+# write heightMap columns as runs ([y, z0, x, z1]:material), 0 for one line per voxel
+heightMapRuns = True
+
+# number of processes converting slices in parallel
+workers = 1
+
+# read the DICOM files directly instead of the pnm files from convert.py
+direct = False
+# apply RescaleSlope/RescaleIntercept to the DICOM values (direct mode only)
+rescale = True
+
+# only build the histogram next to the slices (see histogram.py), no save file
+histogramOnly = False
+
+# several threshold ranges in one pass over the slices,
+# bands=minVal:maxVal[:material or save file],...
+bandArgs = []
+
+# downsampled levels written next to the save files (levels=2,4,8),
+# reduced by the "mean" or the "majority" of every block
+levelArgs = []
+levelReduce = "mean"
+
+# convert only a region: roi=x0,y0,z0,x1,y1,z1 (x: row, y: column, z: slice,
+# inclusive), the saved coordinates start at 0,0,0 of the region
+roi = None
+# find the bounding box of the accepted voxels in a pre pass and convert only that
+autoCrop = False
 
 def fileNameHasNumber(name):
 	parts = name.split(".")
@@ -47,7 +82,14 @@ def getInt(name):
 
 
 sm = saveModule.saveModule()
-sav = open(sm.getSaveDest(), "w")
+
+# write buffer for the save file, slices are written as soon as they are converted
+saveBufferSize = 4 * 1024 * 1024
+
+# compress= gzip compresses the save files, every slice on its own in the workers
+compressSave = sm.compression is not None
+if compressSave and sm.compression != "zlib":
+	print "dcm2save.py writes text saves, they are compressed with gzip (zlib)"
 
 sourceFolder = "./tmp"
 sourceFiles = []
@@ -63,18 +105,28 @@ for arg in sys.argv:
 		materialSwitch = int(arg.replace("materialSwitch=", ""))
 	elif arg.startswith("heightMap="):
 		heightMap = bool(int(arg.replace("heightMap=", "")))
-
-if heightMap:
-	sourceFiles.append(sys.argv[1])
-else:
-	sourceFilesTmp = os.listdir(sourceFolder)
-	sourceFilesTmp.sort(key=getInt)
-	#sourceFiles = sorted(sourceFiles, key=lambda x: int(x.split('.')[3]))
-
-	for i in range(len(sourceFilesTmp)):
-		if not sourceFilesTmp[i].lower().endswith(".md") and fileNameHasNumber(sourceFilesTmp[i]):
-			sourceFiles.append(os.path.join(sourceFolder, sourceFilesTmp[i]))
-
+	elif arg.startswith("runs="):
+		heightMapRuns = bool(int(arg.replace("runs=", "")))
+	elif arg.startswith("saveBuffer="):
+		saveBufferSize = int(arg.replace("saveBuffer=", ""))
+	elif arg.startswith("workers="):
+		workers = max(1, int(arg.replace("workers=", "")))
+	elif arg.startswith("direct="):
+		direct = bool(int(arg.replace("direct=", "")))
+	elif arg.startswith("rescale="):
+		rescale = bool(int(arg.replace("rescale=", "")))
+	elif arg.startswith("histogramOnly="):
+		histogramOnly = bool(int(arg.replace("histogramOnly=", "")))
+	elif arg.startswith("bands="):
+		bandArgs = arg.replace("bands=", "").split(",")
+	elif arg.startswith("levels="):
+		levelArgs = [int(factor) for factor in arg.replace("levels=", "").split(",")]
+	elif arg.startswith("reduce="):
+		levelReduce = arg.replace("reduce=", "")
+	elif arg.startswith("roi="):
+		roi = [int(coord) for coord in arg.replace("roi=", "").split(",")]
+	elif arg.startswith("autoCrop="):
+		autoCrop = bool(int(arg.replace("autoCrop=", "")))
 
 #tiffiles.sort(key=getint)
 #finalStr = ""
@@ -84,61 +136,158 @@ else:
 
 
 class statistics(object):
+	""" conversion statistics, built on the intensity histogram of all
+	converted values (see histogram.py)
+	"""
 	def __init__(self):
 		self.mt = multiTimer.multiTimer()
 		self.mt.start("runtime")
-		self.minValue = -1
-		self.maxValue = 0
-		self.totalValues = 0
-		self.totalAcceptedValues = 0
+		self.histogram = histogram.intensityHistogram()
 	
-	def addVal(self, val, isAccepted=False):
-		self.totalValues += 1
-		if isAccepted:
-			self.totalAcceptedValues += 1
-		
-		if val > self.maxValue:
-			self.maxValue = val
-		elif val < self.minValue or self.minValue == -1:
-			self.minValue = val
+	def addValues(self, values):
+		""" counts a whole numpy array of values at once
+		"""
+		self.histogram.add(values)
+	
+	def merge(self, other):
+		""" adds the counts of another statistics object, e.g. from a worker process
+		"""
+		self.histogram.merge(other.histogram)
 			
 	def printStats(self):
 		self.mt.stop("runtime")
 		print "duration:", self.mt.duration("runtime")
-		print "minValue:", self.minValue
-		print "maxValue:", self.maxValue
-		print "accepted values:", self.totalAcceptedValues, "/", self.totalValues
+		print "minValue:", self.histogram.minValue()
+		print "maxValue:", self.histogram.maxValue()
+		for engine, saveIndex in BANDS:
+			result = self.histogram.query(engine)
+			if len(BANDS) > 1:
+				print "band", engine.minVal, "-", engine.maxVal, "=>", SAVE_FILES[saveIndex]
+			print "accepted values:", result["accepted"], "/", self.histogram.totalValues()
+			for material in sorted(result["materials"]):
+				print "material", material, ":", result["materials"][material]
 
 STATS = statistics()
-
-def getUncompressed():
-	finalStr = ""
-
-	countX = 0
-	countY = 0
-	countZ = 0
-	for z in sourceFiles:
-		print z
-		ds = dicom.read_file(z)
-
-		countX = 0
-		for x in ds.pixel_array:
-
-			countY = 0
-			for y in x:
-				if y >= minVal and y <= maxVal:
-					material = 0
-					for i in xrange(materialMatrixL):
-						if y > minVal + materialSwitch * i:
-							material = i
-
-					finalStr += "[{y}, {z}, {x}]=>{mat}\n".format(x=countX, y=countY, z=countZ, mat=material)
-					#finalStr += str(y) + ","
-				countY += 1
-			countX += 1
-		countZ += 1
-		#finalStr += "\n"
-	return finalStr
+ENGINE = thresholdEngine.thresholdEngine(minVal, maxVal, materialSwitch, materialMatrixL, heightMap, runs=heightMapRuns)
+
+# the save files written and a list of (thresholdEngine, index in SAVE_FILES)
+SAVE_FILES = []
+BANDS = []
+for band in bandArgs:
+	bandParts = band.split(":")
+	bandMaterial = None
+	bandSaveFile = sm.getSaveDest()
+	if len(bandParts) > 2:
+		if bandParts[2].isdigit():
+			bandMaterial = int(bandParts[2])
+		else:
+			bandSaveFile = os.path.join(sm.saveFolder, bandParts[2])
+	
+	if not bandSaveFile in SAVE_FILES:
+		SAVE_FILES.append(bandSaveFile)
+	BANDS.append((thresholdEngine.thresholdEngine(int(bandParts[0]), int(bandParts[1]), materialSwitch,
+		materialMatrixL, heightMap, bandMaterial, heightMapRuns), SAVE_FILES.index(bandSaveFile)))
+
+if not BANDS:
+	SAVE_FILES.append(sm.getSaveDest())
+	BANDS.append((ENGINE, 0))
+
+def getLevelFileName(fileName, factor):
+	""" saves/roflcopter.sav => saves/roflcopter.4x.sav
+	"""
+	root, ext = os.path.splitext(fileName)
+	return "{0}.{1}x{2}".format(root, factor, ext)
+
+# the downsampled levels, every level is written for every save file
+LEVELS = []
+if not histogramOnly:
+	LEVELS = [pyramid.pyramidLevel(factor, levelReduce) for factor in levelArgs]
+LEVEL_SAVE_FILES = [getLevelFileName(saveFile, level.factor) for level in LEVELS for saveFile in SAVE_FILES]
+
+def rescalePixels(pixels, slope, intercept):
+	""" applies the DICOM modality rescale (RescaleSlope/RescaleIntercept),
+	so CT values are Hounsfield units and stay comparable between studies
+	"""
+	if slope == int(slope) and intercept == int(intercept):
+		pixels = pixels.astype(numpy.int32)
+		if slope != 1:
+			pixels *= int(slope)
+		if intercept != 0:
+			pixels += int(intercept)
+		return pixels
+	return numpy.rint(pixels * slope + intercept).astype(numpy.int32)
+
+# header information of the multi-frame files read by this process, parsed once per file
+FRAME_INFOS = {}
+
+def getRescale(ds, frame=0):
+	""" returns (slope, intercept) of a slice, enhanced multi-frame files
+	keep them in the functional groups instead of the top level
+	"""
+	if "RescaleSlope" in ds or "RescaleIntercept" in ds:
+		return float(getattr(ds, "RescaleSlope", 1)), float(getattr(ds, "RescaleIntercept", 0))
+	for groupsName, index in (("PerFrameFunctionalGroupsSequence", frame), ("SharedFunctionalGroupsSequence", 0)):
+		groups = getattr(ds, groupsName, None)
+		if groups and len(groups) > index and "PixelValueTransformationSequence" in groups[index]:
+			transformation = groups[index].PixelValueTransformationSequence[0]
+			return float(getattr(transformation, "RescaleSlope", 1)), float(getattr(transformation, "RescaleIntercept", 0))
+	return 1.0, 0.0
+
+def getFrameInfo(filename):
+	""" reads the header of a multi-frame file once, returns where the
+	frames are and how to read them
+	"""
+	if filename in FRAME_INFOS:
+		return FRAME_INFOS[filename]
+
+	# the pixel data stays on disk, only its position in the file is read
+	ds = dicomIndex.readFile(filename, defer_size=1024)
+	pixelData = dict.__getitem__(ds, 0x7fe00010)
+	if pixelData.length == 0xffffffff:
+		raise NotImplementedError(filename + ": compressed multi-frame files are not supported, decompress them first (dcmdjpeg) or use convert.py")
+	if getattr(ds, "PlanarConfiguration", 0) == 1:
+		raise NotImplementedError(filename + ": planar color frames are not supported, use convert.py")
+
+	samples = getattr(ds, "SamplesPerPixel", 1)
+	kind = "i" if getattr(ds, "PixelRepresentation", 0) else "u"
+	dtype = numpy.dtype(("<" if ds.is_little_endian else ">") + kind + str(ds.BitsAllocated // 8))
+	frames = int(ds.NumberOfFrames)
+	info = {"offset":pixelData.value_tell, "dtype":dtype, "frameSize":ds.Rows * ds.Columns * samples,
+		"width":ds.Columns, "height":ds.Rows, "samples":samples, "maxval":2 ** ds.BitsStored - 1,
+		"rescale":[getRescale(ds, frame) for frame in range(frames)]}
+	FRAME_INFOS[filename] = info
+	return info
+
+def readDicomFrame(filename, frame):
+	""" maps one frame of an uncompressed multi-frame file, only this frame
+	is read from disk, never the whole pixel data of the file
+	"""
+	info = getFrameInfo(filename)
+	pixels = numpy.memmap(filename, dtype=info["dtype"], mode="r",
+		offset=info["offset"] + frame * info["frameSize"] * info["dtype"].itemsize, shape=(info["frameSize"],))
+	if rescale:
+		pixels = rescalePixels(pixels, *info["rescale"][frame])
+	return {"fileFormat":"DICOM", "width":info["width"], "height":info["height"], "samples":info["samples"],
+		"maxval":info["maxval"], "pixels":pixels}
+
+def readDicom( source ):
+	""" reads the pixel data of a DICOM file in process, replaces the
+	convert.py/dcmj2pnm round trip through tmp/
+
+	`source` is a file name or (file name, frame index) for a frame of a
+	multi-frame file (see dicomIndex.getSortedFrames)
+	"""
+	if isinstance(source, tuple):
+		return readDicomFrame(*source)
+
+	ds = dicomIndex.readFile(source)
+	pixels = ds.pixel_array
+	if rescale:
+		pixels = rescalePixels(pixels, *getRescale(ds))
+	
+	# same layout as a pnm file from dcmj2pnm: width = columns, height = rows
+	return {"fileFormat":"DICOM", "width":ds.Columns, "height":ds.Rows, "samples":getattr(ds, "SamplesPerPixel", 1),
+		"maxval":2 ** ds.BitsStored - 1, "pixels":pixels.reshape(-1)}
 
 def makelong(s): 
 	n = 0 
@@ -237,21 +386,10 @@ def getCompressed():
 
 
 def readPgm( filename, endian='>' ):
-	fd = open(filename,'rb')
-	fileFormat, width, height, samples, maxval = pnmHeader.read_pnm_header( fd )
-	pixels = numpy.fromfile( fd, dtype='u1' if maxval < 256 else endian+'u2' )
-	#print fileFormat, width, height, samples, maxval, len(pixels), pixels
-	
-	#print dir(pixels)
-	
-	return {"fileFormat":fileFormat, "width":width, "height":height, "samples":samples, "maxval":maxval,
-		"pixels":pixels.tolist()}
-		#"pixels":pixels.reshape(height, width, samples)}  #TODO: learn NUMPY!
+	return readPnm(filename, endian)
 	
 def getFromPgm():
 	#http://paulbourke.net/dataformats/ppm/
-	finalStr = ""
-
 	countX = 0
 	countY = 0
 	countZ = 0
@@ -266,6 +404,7 @@ def getFromPgm():
 		width = pnm["width"]
 		height = pnm["height"]
 
+		sliceLines = []
 		countX = 0
 		for x in xrange(width):#pnm["pixels"]:
 			countY = 0
@@ -287,100 +426,246 @@ def getFromPgm():
 							material = materialMatrix[i]
 					
 					countVoxel += 1
-					finalStr += "[{y}, {z}, {x}]=>{mat}\n".format(x=x, y=y, z=countZ, mat=material)
+					sliceLines.append("[{y}, {z}, {x}]=>{mat}\n".format(x=x, y=y, z=countZ, mat=material))
 				else:
 					pass
 					#print "lost:", x,y,z,':', pixVal
-					#finalStr += str(y) + ","
 				countY += 1
 			countX += 1
 		countZ += 1
+		yield "".join(sliceLines)
 		#if countZ > 10:
 		#	break
-		#finalStr += "\n"
 		break
-	return finalStr
 
-def readPnm( filename ):
+def readPnm( filename, endian='>' ):
+	""" maps the pixels of a pnm/pgm file into memory, nothing is copied or
+	converted into python objects, "pixels" is a numpy.memmap of the shape
+	(height, width, samples), 16 bit values are big endian
+	"""
 	fd = open(filename,'rb')
-	endian = '>'
-	fileFormat, width, height, samples, maxval = pnmHeader.read_pnm_header( fd )
-	pixels = numpy.fromfile( fd, dtype='u1' if maxval < 256 else endian+'u2' )
-	#print fileFormat, width, height, samples, maxval, len(pixels), pixels
+	fileFormat, width, height, samples, maxval, offset = pnmHeader.read_pnm_header_block( fd )
+	fd.seek(0, os.SEEK_END)
+	fileSize = fd.tell()
+	fd.close()
 	
-	#print dir(pixels)
+	dtype = numpy.dtype('u1' if maxval < 256 else endian+'u2')
+	count = min((fileSize - offset) // dtype.itemsize, width * height * samples)
+	if count == width * height * samples:
+		pixels = numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(height, width, samples))
+	elif count > 0:
+		# truncated file, just use what is there
+		pixels = numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+	else:
+		pixels = numpy.zeros(0, dtype=dtype)
 	
 	return {"fileFormat":fileFormat, "width":width, "height":height, "samples":samples, "maxval":maxval,
-		"pixels":pixels.tolist()}
-		#"pixels":pixels.reshape(height, width, samples)}  #TODO: learn NUMPY!
+		"pixels":pixels}
 	
-
-def getFromPnm():
+# the region that is converted, roi or the box found by autoCrop
+ROI = roi
+
+def initWorker(region):
+	""" sets ROI in a worker process, spawned workers (Windows, macOS)
+	only get the module level settings, not the box found by autoCrop
+	"""
+	global ROI
+	ROI = region
+
+def getSliceValues(pnm):
+	""" returns the x (row), y (column) and gray value arrays of a slice,
+	DICOM slices walk their (Rows, Columns) grid, pnm slices keep the old
+	indexing so their saves stay the same
+	"""
+	if pnm["fileFormat"] == "DICOM":
+		return ENGINE.getGridValues(pnm["pixels"], pnm["height"], pnm["width"], pnm["samples"])
+	return ENGINE.getSliceValues(pnm["pixels"], pnm["width"], pnm["height"])
+
+def convertSlice(job):
+	""" converts a single slice, runs in the worker processes when workers > 1
+	
+	Parameters
+	----------
+	job : tuple of len 3
+		(slice reader like readPnm or readDicom, z index of the slice, file name)
+	
+	Returns
+	-------
+	(file name, accepted voxel count, save file lines for every file in SAVE_FILES,
+	statistics of the slice, the slice as (rows, columns) array if LEVELS are built)
+	"""
+	readSlice, countZ, fileName = job
+	pnm = readSlice(fileName)
+
+	# the slice is read once, every band thresholds the same values
+	xs, ys, values = cropValues(*getSliceValues(pnm))
+	sliceStats = statistics()
+	sliceStats.addValues(values)
+	
+	sliceVoxel = 0
+	sliceLines = [[] for saveFile in SAVE_FILES]
+	for engine, saveIndex in BANDS:
+		mask = engine.getMask(values)
+		sliceVoxel += int(mask.sum())
+		if not histogramOnly:
+			sliceLines[saveIndex].append(engine.formatSlice(xs[mask], ys[mask], values[mask], countZ))
+	
+	image = None
+	if LEVELS:
+		image = getImage(pnm)
+		if ROI:
+			image = image[ROI[0]:ROI[3] + 1, ROI[1]:ROI[4] + 1]
+	return fileName, sliceVoxel, [compressText("".join(lines)) for lines in sliceLines], sliceStats, image
+
+def compressText(text):
+	""" returns the text as a complete gzip member if compressSave is set,
+	members written one after another are read as one gzip file
+	"""
+	if not compressSave or not text:
+		return text
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(text) + compressor.flush()
+
+def cropValues(xs, ys, values, rebase=True):
+	""" keeps only the pixels inside of ROI, with `rebase` the coordinates
+	start at the corner of ROI
+	"""
+	if not ROI:
+		return xs, ys, values
+	x0, y0, z0, x1, y1, z1 = ROI
+	inRoi = (xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)
+	if rebase:
+		return xs[inRoi] - x0, ys[inRoi] - y0, values[inRoi]
+	return xs[inRoi], ys[inRoi], values[inRoi]
+
+def getJobs(readSlice, rebase=True):
+	""" returns the jobs for convertSlice, only slices inside of ROI,
+	with `rebase` the z index starts at the first slice of ROI
+	"""
+	jobs = []
+	for countZ, fileName in enumerate(sourceFiles):
+		if ROI and (countZ < ROI[2] or countZ > ROI[5]):
+			continue
+		if ROI and rebase:
+			countZ -= ROI[2]
+		jobs.append((readSlice, countZ, fileName))
+	return jobs
+
+def getSliceBounds(job):
+	""" pre pass of autoCrop, returns (x0, y0, x1, y1) of the pixels
+	accepted by any band, None if there are none
+	"""
+	readSlice, countZ, fileName = job
+	pnm = readSlice(fileName)
+	xs, ys, values = cropValues(*getSliceValues(pnm), rebase=False)
+	mask = numpy.zeros(len(values), dtype=bool)
+	for engine, saveIndex in BANDS:
+		mask |= engine.getMask(values)
+	if not mask.any():
+		return None
+	return int(xs[mask].min()), int(ys[mask].min()), int(xs[mask].max()), int(ys[mask].max())
+
+def getBoundingBox(readSlice):
+	""" returns the bounding box [x0, y0, z0, x1, y1, z1] of all voxels
+	(inside of ROI), None if no pixel is in range
+	"""
+	jobs = getJobs(readSlice, rebase=False)
+	if workers > 1:
+		pool = multiprocessing.Pool(workers, initWorker, (ROI,))
+		results = pool.map(getSliceBounds, jobs)
+		pool.close()
+		pool.join()
+	else:
+		results = [getSliceBounds(job) for job in jobs]
+	
+	box = None
+	for job, bounds in zip(jobs, results):
+		if bounds is None:
+			continue
+		countZ = job[1]
+		x0, y0, x1, y1 = bounds
+		if box is None:
+			box = [x0, y0, countZ, x1, y1, countZ]
+		else:
+			box = [min(box[0], x0), min(box[1], y0), box[2], max(box[3], x1), max(box[4], y1), countZ]
+	return box
+
+def getImage(pnm):
+	""" returns the (first sample of the) slice as (rows, columns) array
+	"""
+	width, height, samples = pnm["width"], pnm["height"], pnm["samples"]
+	pixels = numpy.asarray(pnm["pixels"]).reshape(-1)
+	if len(pixels) < width * height * samples:
+		# truncated file
+		pixels = numpy.concatenate((pixels, numpy.zeros(width * height * samples - len(pixels), dtype=pixels.dtype)))
+	return numpy.array(pixels.reshape(height, width, samples)[:, :, 0])
+
+def convertLevel(level, reduced):
+	""" thresholds a reduced slice of a pyramid level with every band,
+	returns the lines for every file in SAVE_FILES
+	"""
+	levelLines = [[] for saveFile in SAVE_FILES]
+	if reduced is None:
+		return ["" for saveFile in SAVE_FILES]
+	
+	rows, columns = reduced.shape
+	xs = numpy.repeat(numpy.arange(rows), columns)
+	ys = numpy.tile(numpy.arange(columns), rows)
+	values = reduced.reshape(-1)
+	for engine, saveIndex in BANDS:
+		mask = engine.getMask(values)
+		levelLines[saveIndex].append(engine.formatSlice(xs[mask], ys[mask], values[mask], level.count - 1))
+	return [compressText("".join(lines)) for lines in levelLines]
+
+def imapOrdered(pool, func, jobs, window):
+	""" like pool.imap, but never more than `window` results are waiting
+	for the writer, so the memory stays bounded
+	"""
+	pending = deque()
+	for job in jobs:
+		pending.append(pool.apply_async(func, (job,)))
+		if len(pending) >= window:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+def getFromSlices(readSlice):
+	""" yields the save file lines slice by slice, so only one slice
+	is kept in memory at a time
+	
+	Parameters
+	----------
+	readSlice : function
+		readPnm for the files from convert.py, readDicom for DICOM files
+	"""
 	#http://paulbourke.net/dataformats/ppm/
-	finalStr = ""
+	jobs = getJobs(readSlice)
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers, initWorker, (ROI,))
+		results = imapOrdered(pool, convertSlice, jobs, workers * 2)
+	else:
+		results = (convertSlice(job) for job in jobs)
 
-	countX = 0
-	countY = 0
-	countZ = 0
 	countVoxel = 0
-	for z in sourceFiles:
-		#if countVoxel >= 200000:
-		#	break
-		print z
-		#z = sourceFiles[1]
-		pnm = readPnm(z)
-		width = pnm["width"]
-		height = pnm["height"]
-
-		countX = 0
-		for x in xrange(width):#pnm["pixels"]:
-			countY = 0
-			for y in xrange(height):#x:
-				#print x,y
-				#pixVal = pnm["pixels"][x][y]
-				#pixVal = y
-				index = (countX * width) + y
-				if index >= len(pnm["pixels"]):
-					#print countX, index, len(pnm["pixels"])
-					break
-					
-				pixVal = pnm["pixels"][index]
-				#print pixVal
-				if pixVal >= minVal and pixVal <= maxVal:
-					STATS.addVal(pixVal, True)
-					material = (pixVal - minVal) * materialSwitch
-					
-					if material > materialMatrixL:
-						#print "over value:", pixVal, "/", material
-						material = materialMatrixL
-					elif material < materialSwitch:
-						material = pixVal - minVal
-					#for i in xrange(materialMatrixL):
-					#	if pixVal >= minVal + materialSwitch * i:
-					#		material = i
-					
-					countVoxel += 1
-					
-					if heightMap:
-						for zI in range((pixVal - minVal)):
-							finalStr += "[{y}, {z}, {x}]:{mat}\n".format(x=x, y=y, z=zI, mat=material)
-					else:
-						finalStr += "[{y}, {z}, {x}]:{mat}\n".format(x=x, y=y, z=countZ, mat=material)
-
-					#print "added:", x,y,z,':', pixVal
-				else:
-					STATS.addVal(pixVal, False)
-					#print "lost:", x,y,z,':', pixVal
-					#finalStr += str(y) + ","
-				countY += 1
-			countX += 1
-		countZ += 1
+	for fileName, sliceVoxel, sliceStrs, sliceStats, image in results:
+		print fileName
+		STATS.merge(sliceStats)
+		countVoxel += sliceVoxel
+		for level in LEVELS:
+			sliceStrs.extend(convertLevel(level, level.addSlice(image)))
+		yield sliceStrs
 		print "current voxel:", countVoxel
-		#if countZ > 10:
-		#	break
-		#finalStr += "\n"
-		
-	return finalStr
+	
+	# the last slices of the levels, if the series is not a multiple of the factor
+	sliceStrs = ["" for saveFile in SAVE_FILES]
+	for level in LEVELS:
+		sliceStrs.extend(convertLevel(level, level.flush()))
+	yield sliceStrs
+	
+	if pool:
+		pool.close()
+		pool.join()
 	
 
 def flip_vert(picture):
@@ -416,7 +701,69 @@ def flip_horiz(picture):
 #fh.write(getCompressed())
 #fh.close()
 #exit()
-#print finalStr
-sav.write(getFromPnm())
-sav.close()
-STATS.printStats()
+def writeSave(sliceChunks, fileNames):
+	""" writes the chunks of getFromSlices (one string for every file in
+	`fileNames`) through buffered files as soon as they are produced
+	"""
+	savs = [open(fileName, "wb", saveBufferSize) for fileName in fileNames]
+	for chunks in sliceChunks:
+		for sav, chunk in zip(savs, chunks):
+			sav.write(chunk)
+	for sav in savs:
+		sav.close()
+
+def main():
+	""" converts the slices of sourceFolder, the worker processes only
+	import this module, they must not run the conversion again
+	"""
+	global ROI, sourceFiles
+	# slice order written by convert.py, taken from the DICOM headers
+	sliceOrderPath = os.path.join(sourceFolder, "slices.order")
+
+	if heightMap:
+		sourceFiles.append(sys.argv[1])
+	elif direct:
+		# ordered by the geometry in the DICOM headers, not by the file names
+		sourceFiles = dicomIndex.getSortedFrames(sourceFolder)
+	elif os.path.exists(sliceOrderPath):
+		fh = open(sliceOrderPath, 'r')
+		for fileName in fh.read().split("\n"):
+			if fileName and os.path.exists(os.path.join(sourceFolder, fileName)):
+				sourceFiles.append(os.path.join(sourceFolder, fileName))
+		fh.close()
+	else:
+		sourceFilesTmp = os.listdir(sourceFolder)
+		sourceFilesTmp.sort(key=getInt)
+		#sourceFiles = sorted(sourceFiles, key=lambda x: int(x.split('.')[3]))
+
+		for i in range(len(sourceFilesTmp)):
+			# skip the readme, the histogram sidecars and the files of convert.py
+			if not sourceFilesTmp[i].lower().endswith(dicomIndex.IGNORED_ENDINGS) and fileNameHasNumber(sourceFilesTmp[i]):
+				sourceFiles.append(os.path.join(sourceFolder, sourceFilesTmp[i]))
+
+	readSlice = readPnm
+	if direct:
+		readSlice = readDicom
+
+	if autoCrop:
+		ROI = getBoundingBox(readSlice)
+		print "auto crop:", ROI
+		if ROI is None:
+			print "no pixel between minVal and maxVal"
+			ROI = roi
+
+	if histogramOnly:
+		for chunk in getFromSlices(readSlice):
+			pass
+	else:
+		writeSave(getFromSlices(readSlice), SAVE_FILES + LEVEL_SAVE_FILES)
+
+	# keep the histogram next to the slices, histogram.py answers threshold questions with it
+	# (not for a region, it would not describe the whole study)
+	if not ROI:
+		STATS.histogram.save(histogram.getSidecarPath(sourceFolder, direct, rescale))
+	STATS.printStats()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,142 @@
+""" Slice order of a folder with DICOM files.
+
+Only the headers are read (no pixel data), the slices are ordered by their
+position along the slice normal (ImagePositionPatient/ImageOrientationPatient),
+then by InstanceNumber, so the file names do not matter. Multi-frame files
+(enhanced CT/MR, ultrasound cine) count as one slice per frame. The index is cached
+in the folder (dicom.index) with size and mtime of every file, a second run
+only reads the headers of new or changed files.
+"""
+import os
+import json
+import struct
+import dicom
+from dicom.filereader import InvalidDicomError
+
+INDEX_NAME = "dicom.index"
+# 3: files without preamble and DICM prefix are read too
+INDEX_VERSION = 3
+
+# files DICraft itself writes into the folders, never DICOM files
+IGNORED_ENDINGS = (".md", ".npz", ".manifest", ".order", ".index", ".part")
+
+
+def getSlicePosition(ds):
+	""" Returns the position of the slice along its normal, None if the
+	header has no geometry.
+	"""
+	if "ImagePositionPatient" in ds:
+		position = [float(value) for value in ds.ImagePositionPatient]
+		if "ImageOrientationPatient" in ds:
+			o = [float(value) for value in ds.ImageOrientationPatient]
+			normal = (o[1] * o[5] - o[2] * o[4], o[2] * o[3] - o[0] * o[5], o[0] * o[4] - o[1] * o[3])
+			return sum(n * p for n, p in zip(normal, position))
+		return position[2]
+	if "SliceLocation" in ds:
+		return float(ds.SliceLocation)
+	return None
+
+def readFile(path, **options):
+	""" Reads a DICOM file, also one without the 128 byte preamble and the
+	DICM prefix (older PACS and CD exports), pydicom only reads those with
+	force=True. Such a file must have Rows and Columns.
+	"""
+	try:
+		return dicom.read_file(path, **options)
+	except InvalidDicomError as error:
+		ds = dicom.read_file(path, force=True, **options)
+		if not ("Rows" in ds and "Columns" in ds):
+			raise error
+		return ds
+
+def readEntry(path):
+	""" Reads the header of a file, returns its index entry.
+	"""
+	stat = os.stat(path)
+	entry = {"size": stat.st_size, "mtime": stat.st_mtime, "image": False,
+		"position": None, "instance": None, "frames": 1}
+	try:
+		# pydicom parses the elements lazily, broken ones fail on access
+		ds = readFile(path, stop_before_pixels=True)
+		image = "Rows" in ds and "Columns" in ds
+		position = getSlicePosition(ds)
+		instance = None
+		if "InstanceNumber" in ds and ds.InstanceNumber != "":
+			instance = int(ds.InstanceNumber)
+		frames = 1
+		if "NumberOfFrames" in ds and ds.NumberOfFrames != "":
+			frames = max(int(ds.NumberOfFrames), 1)
+	except (InvalidDicomError, IOError, EOFError, AttributeError, KeyError, ValueError, TypeError, struct.error):
+		# not a DICOM file or a broken one, keep it in the index anyway so it is not read again
+		return entry
+
+	entry.update(image=image, position=position, instance=instance, frames=frames)
+	return entry
+
+def getIndex(folder):
+	""" Returns the index {file name: entry} of the folder, reading only
+	the headers of files that are new or changed since the cached index.
+	"""
+	indexPath = os.path.join(folder, INDEX_NAME)
+	cached = {}
+	if os.path.exists(indexPath):
+		fh = open(indexPath, 'r')
+		data = json.load(fh)
+		fh.close()
+		if data.get("version") == INDEX_VERSION:
+			cached = data["files"]
+
+	index = {}
+	changed = False
+	for name in os.listdir(folder):
+		path = os.path.join(folder, name)
+		if name.lower().endswith(IGNORED_ENDINGS) or not os.path.isfile(path):
+			continue
+		stat = os.stat(path)
+		entry = cached.get(name)
+		if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+			entry = readEntry(path)
+			changed = True
+		index[name] = entry
+
+	if changed or len(index) != len(cached):
+		try:
+			fh = open(indexPath, 'w')
+			json.dump({"version": INDEX_VERSION, "files": index}, fh)
+			fh.close()
+		except IOError:
+			# read only folder (CD, PACS mount), no cache then
+			print "could not write", indexPath
+
+	return index
+
+def getSortedFiles(folder):
+	""" Returns the paths of all DICOM images in the folder in slice order.
+	"""
+	return [os.path.join(folder, name) for name in sortNames(getIndex(folder))]
+
+def sortNames(index):
+	""" Returns the names of all images of an index in slice order.
+	"""
+	def sortKey(name):
+		entry = index[name]
+		return (entry["position"] is None, entry["position"], entry["instance"] is None, entry["instance"], name)
+
+	names = [name for name in index if index[name]["image"]]
+	names.sort(key=sortKey)
+	return names
+
+def getSortedFrames(folder):
+	""" Returns all slices of the folder in order, the path for a single
+	frame file and (path, frame index) for every frame of a multi-frame file.
+	"""
+	index = getIndex(folder)
+	frames = []
+	for name in sortNames(index):
+		path = os.path.join(folder, name)
+		count = index[name]["frames"]
+		if count == 1:
+			frames.append(path)
+		else:
+			frames.extend((path, frame) for frame in range(count))
+	return frames
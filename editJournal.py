@@ -0,0 +1,117 @@
+""" Append only journal of the edits made in the editor.
+
+Every added or removed block is one fixed size record (x, y, z, material,
+-1 for a removed block) appended to a file next to the save. Loading replays
+the journal over the save, so F5 only has to flush the journal. From time to
+time the journal is compacted into a new save (see saveModule).
+
+While a compaction runs the journal goes on in a new file, the old one is
+kept as <journal>.old until the new save is written. Replaying a record
+twice does not change the result, a crash at any point loses nothing that
+was flushed.
+"""
+import os
+import struct
+import threading
+import numpy
+
+# x, y, z, material (-1 for a removed block)
+RECORD = struct.Struct("<iiih")
+JOURNAL_RECORD = numpy.dtype([("x", "<i4"), ("y", "<i4"), ("z", "<i4"), ("material", "<i2")])
+
+REMOVED = -1
+
+
+def readJournal(path):
+	""" Returns the records of a journal file as numpy array of JOURNAL_RECORD,
+	a record cut off by a crash is ignored.
+	"""
+	if not os.path.exists(path):
+		return numpy.zeros(0, dtype=JOURNAL_RECORD)
+	fh = open(path, 'rb')
+	data = fh.read()
+	fh.close()
+	count = len(data) // JOURNAL_RECORD.itemsize
+	return numpy.frombuffer(data[:count * JOURNAL_RECORD.itemsize], dtype=JOURNAL_RECORD)
+
+def replayJournal(model, path):
+	""" Applies the records of a journal file to the model, returns the
+	number of records.
+	"""
+	records = readJournal(path)
+	for x, y, z, material in records.tolist():
+		position = (x, y, z)
+		if material == REMOVED:
+			if position in model.world:
+				model.remove_block(position, False)
+			else:
+				# a block of a region chunk that is not loaded yet
+				model.record_unloaded(position, None)
+		else:
+			model.add_block(position, material, False)
+	return len(records)
+
+
+class editJournal(object):
+	""" Appends the edits to a journal file, every record is flushed so
+	the edits survive a crash of the editor.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.fh = open(self.path, 'ab')
+		self.records = os.path.getsize(self.path) // RECORD.size
+
+	def add(self, position, material):
+		self.write(position, material)
+
+	def remove(self, position):
+		self.write(position, REMOVED)
+
+	def write(self, position, material):
+		x, y, z = position
+		with self.lock:
+			self.fh.write(RECORD.pack(x, y, z, material))
+			self.fh.flush()
+			self.records += 1
+
+	def sync(self):
+		""" Makes sure the journal is on the disk, not only in the OS cache.
+		"""
+		with self.lock:
+			self.fh.flush()
+			os.fsync(self.fh.fileno())
+
+	def rotate(self):
+		""" Moves the records to <journal>.old and starts an empty journal,
+		called when a compaction starts.
+		"""
+		with self.lock:
+			self.fh.close()
+			oldPath = self.path + ".old"
+			if os.path.exists(oldPath):
+				# left over from a compaction that did not finish, keep its records first
+				newFh = open(self.path, 'rb')
+				oldFh = open(oldPath, 'ab')
+				oldFh.write(newFh.read())
+				oldFh.close()
+				newFh.close()
+				os.remove(self.path)
+			else:
+				os.rename(self.path, oldPath)
+			self.fh = open(self.path, 'ab')
+			self.records = 0
+
+	def clear(self):
+		""" Drops all records, the save contains them now.
+		"""
+		with self.lock:
+			self.fh.close()
+			self.fh = open(self.path, 'wb')
+			self.records = 0
+		if os.path.exists(self.path + ".old"):
+			os.remove(self.path + ".old")
+
+	def close(self):
+		with self.lock:
+			self.fh.close()
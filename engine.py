@@ -1,6 +1,10 @@
 import time
+import itertools
+import numpy
 import multiTimer
 import saveModule
+import chunkWorld
+import chunkMesh
 
 from collections import deque
 # TODO: remove/move this kind of stuff to rendering engine!
@@ -13,8 +17,13 @@ from pyglet.graphics import TextureGroup
 # not changeable, yet
 CUBE_SIZE = 0.5
 
-# Size of sectors used to ease block loading.
-SECTOR_SIZE = 150
+# Size of the chunks the world is stored in, region saves use the same
+# chunks and changes are tracked per chunk.
+CHUNK_SIZE = 32
+
+# Size of sectors used to ease block loading, a whole number of chunks.
+SECTOR_CHUNKS = 5
+SECTOR_SIZE = SECTOR_CHUNKS * CHUNK_SIZE
 
 def cube_vertices(x, y, z, n):
 	""" Return the vertices of the cube at position x, y, z with size 2*n.
@@ -127,6 +136,50 @@ def sectorize(position):
 	return (x, 0, z)
 
 
+def chunkize(position):
+	""" Returns a tuple representing the chunk for the given block `position`.
+
+	Parameters
+	----------
+	position : tuple of len 3
+
+	Returns
+	-------
+	chunk : tuple of len 3
+
+	"""
+	x, y, z = position
+	return (x / CHUNK_SIZE, y / CHUNK_SIZE, z / CHUNK_SIZE)
+
+
+class ChunkGroup(pyglet.graphics.Group):
+	""" Moves the mesh of a chunk, given relative to the chunk corner, to
+	its place in the world. Groups of the same chunk are equal, so a
+	rebuilt mesh goes back into the same vertex domain.
+
+	"""
+	def __init__(self, chunk, parent=None):
+		super(ChunkGroup, self).__init__(parent)
+		self.chunk = chunk
+		# the corners of the first block of the chunk are at -CUBE_SIZE
+		self.offset = [value * CHUNK_SIZE - CUBE_SIZE for value in chunk]
+
+	def set_state(self):
+		glPushMatrix()
+		glTranslatef(*self.offset)
+
+	def unset_state(self):
+		glPopMatrix()
+
+	def __hash__(self):
+		return hash((self.chunk, self.parent))
+
+	def __eq__(self, other):
+		return (self.__class__ is other.__class__ and
+			self.chunk == other.chunk and
+			self.parent == other.parent)
+
+
 class Model(object):
 
 	def __init__(self):
@@ -138,24 +191,64 @@ class Model(object):
 		self.group = TextureGroup(image.load(TEXTURE_PATH).get_texture())
 
 		# A mapping from position to the texture of the block at that position.
-		# This defines all the blocks that are currently in the world.
-		self.world = {}
+		# This defines all the blocks that are currently in the world. The
+		# blocks are stored in dense chunks, see chunkWorld.
+		self.world = chunkWorld.chunkWorld(CHUNK_SIZE)
 
 		# Same mapping as `world` but only contains blocks that are shown.
 		self.shown = {}
 
-		# Mapping from position to a pyglet `VertextList` for all shown blocks.
+		# Mapping from chunk to a pyglet `IndexedVertexList` with the visible
+		# faces of all blocks of the chunk, see chunkMesh.
 		self._shown = {}
 
-		# Mapping from sector to a list of positions inside that sector.
-		self.sectors = {}
+		# Mapping from chunk to the bytes of its mesh, see mesh_report().
+		self.meshBytes = {}
+
+		# Mapping from chunk to the positions of its blocks in `shown`.
+		self.shownChunks = {}
+
+		# Sectors that are shown, edits there rebuild the chunk meshes.
+		self.shownSectors = set()
+
+		# Shown chunks with edits since their mesh was built, rebuilt by
+		# process_queue() once per frame.
+		self.staleChunks = set()
+
+		# Merge neighboring faces of the same material into bigger quads,
+		# see chunkMesh.buildGreedyMesh.
+		self.greedyMesh = False
+
+		# Arrays of columns (x, y0, z, y1, texture) loaded from a heightMap
+		# save, used by the stl export to write a column as one box.
+		self.runs = []
+
+		# Columns (x, z) that do not match `runs` any more, edited or with
+		# blocks that were not loaded as a column.
+		self.editedColumns = set()
+
+		# Chunks with blocks added or removed since the last load or save,
+		# a region save only rewrites these.
+		self.dirtyChunks = set()
+
+		# Edits in region chunks that are not loaded yet, {chunk: {position:
+		# texture, None if removed}}. The save applies them to the chunks
+		# from the file, loading a chunk keeps the edited positions.
+		self.unloadedEdits = {}
+
+		# Journal of the edits made in the editor, set by the saveModule
+		# after loading, see editJournal.
+		self.journal = None
 
 		# Simple function queue implementation. The queue is populated with
-		# _show_block() and _hide_block() calls
+		# _show_chunk() and _hide_chunk() calls
 		self.queue = deque()
 		
 		# a module to save and load the world
 		self.saveModule = saveModule.saveModule()
+		if self.saveModule.worldFolder is not None:
+			# out of core, the blocks are kept in memory mapped chunk files
+			self.world = chunkWorld.mmapWorld(self.saveModule.worldFolder, CHUNK_SIZE)
 		
 		# notifications to display
 		self.notification = ""
@@ -173,13 +266,13 @@ class Model(object):
 			print "no savefile, generating sample"
 			
 			for x in xrange(len(MATERIALS)):
-				self.add_block((x, 0, 0), MATERIALS[x], immediate=False)
+				self.add_block((x, 0, 0), x, immediate=False)
 				
 			for z in xrange(len(MATERIALS)):
-				self.add_block((0, z, 1), MATERIALS[z], immediate=False)
+				self.add_block((0, z, 1), z, immediate=False)
 				
 			for y in xrange(len(MATERIALS)):
-				self.add_block((0, 2, y), MATERIALS[y], immediate=False)
+				self.add_block((0, 2, y), y, immediate=False)
 		
 	def hit_test(self, position, vector, max_distance=8):
 		""" Line of sight search from current position. If a block is
@@ -243,11 +336,7 @@ class Model(object):
 		blocks, True otherwise.
 
 		"""
-		x, y, z = position
-		for dx, dy, dz in FACES:
-			if (x + dx, y + dy, z + dz) not in self.world:
-				return True
-		return False
+		return self.world.exposed(position)
 
 	def add_block(self, position, texture, immediate=True):
 		""" Add a block with the given `texture` and `position` to the world.
@@ -266,11 +355,56 @@ class Model(object):
 		if position in self.world:
 			self.remove_block(position, immediate)
 		self.world[position] = texture
-		self.sectors.setdefault(sectorize(position), []).append(position)
+		self.dirtyChunks.add(chunkize(position))
+		self.record_unloaded(position, texture)
+		if self.runs:
+			self.editedColumns.add((position[0], position[2]))
+		if self.journal is not None:
+			self.journal.add(position, texture)
 		if immediate:
-			if self.exposed(position):
-				self.show_block(position)
-			self.check_neighbors(position)
+			self.mark_stale(position)
+
+	def add_blocks(self, positions, textures):
+		""" Add many blocks at once, the same as `add_block()` with
+		immediate=False for every block, used to load saves. Loaded blocks
+		are not written to the journal.
+
+		Parameters
+		----------
+		positions : numpy array of shape (n, 3)
+			The (x, y, z) positions of the blocks to add.
+		textures : numpy array of len n
+			The material index of every block.
+
+		"""
+		if not len(positions):
+			return
+		positions = numpy.asarray(positions, dtype=numpy.int64).reshape(-1, 3)
+		self.world.setBlocks(positions, numpy.asarray(textures))
+		chunks = set(itertools.izip(*(positions // CHUNK_SIZE).T.tolist()))
+		self.dirtyChunks.update(chunks)
+		# chunks loaded near the player while the sectors are shown
+		self.staleChunks.update(chunk for chunk in chunks if self.chunk_sector(chunk) in self.shownSectors)
+
+	def add_runs(self, runs):
+		""" Add heightMap columns, used to load saves. The columns are kept
+		in `runs` and written into the world chunk by chunk, they are never
+		expanded into a list of blocks.
+
+		Parameters
+		----------
+		runs : numpy array of shape (n, 5)
+			x, y0, z, y1 (y0 to y1 inclusive) and the material index of
+			every column.
+
+		"""
+		if not len(runs):
+			return
+		runs = numpy.asarray(runs, dtype=numpy.int64).reshape(-1, 5)
+		self.runs.append(runs)
+		chunks = self.world.setRuns(runs)
+		self.dirtyChunks.update(chunks)
+		self.staleChunks.update(chunk for chunk in chunks if self.chunk_sector(chunk) in self.shownSectors)
 
 	def remove_block(self, position, immediate=True):
 		""" Remove the block at the given `position`.
@@ -284,112 +418,167 @@ class Model(object):
 
 		"""
 		del self.world[position]
-		self.sectors[sectorize(position)].remove(position)
+		self.dirtyChunks.add(chunkize(position))
+		self.record_unloaded(position, None)
+		if self.runs:
+			self.editedColumns.add((position[0], position[2]))
+		if self.journal is not None:
+			self.journal.remove(position)
 		if immediate:
-			if position in self.shown:
-				self.hide_block(position)
-			self.check_neighbors(position)
+			self.mark_stale(position)
 		
-	def check_neighbors(self, position):
-		""" Check all blocks surrounding `position` and ensure their visual
-		state is current. This means hiding blocks that are not exposed and
-		ensuring that all exposed blocks are shown. Usually used after a block
-		is added or removed.
+	def record_unloaded(self, position, texture):
+		""" Remember an edit in a region chunk that is not loaded yet, the
+		world only has the edited blocks of that chunk. Returns False for
+		a loaded chunk.
 
 		"""
-		x, y, z = position
-		for dx, dy, dz in FACES:
-			key = (x + dx, y + dy, z + dz)
-			if key not in self.world:
-				continue
-			if self.exposed(key):
-				if key not in self.shown:
-					self.show_block(key)
-			else:
-				if key in self.shown:
-					self.hide_block(key)
-
-	def show_block(self, position, immediate=True):
-		""" Show the block at the given `position`. This method assumes the
-		block has already been added with add_block()
+		chunk = chunkize(position)
+		if self.saveModule.isChunkLoaded(chunk):
+			return False
+		self.unloadedEdits.setdefault(chunk, {})[position] = texture
+		self.dirtyChunks.add(chunk)
+		return True
+
+	def chunk_sector(self, chunk):
+		""" Returns the sector of the given chunk.
+
+		"""
+		return (chunk[0] // SECTOR_CHUNKS, 0, chunk[2] // SECTOR_CHUNKS)
+
+	def mark_stale(self, position):
+		""" Mark the mesh of the chunk of `position` for a rebuild, and the
+		meshes of the chunks next to it if the block is on the chunk border.
+		Only chunks of shown sectors are rebuilt.
+
+		"""
+		chunk = chunkize(position)
+		chunks = [chunk]
+		for axis in xrange(3):
+			local = position[axis] % CHUNK_SIZE
+			if local == 0 or local == CHUNK_SIZE - 1:
+				neighbor = list(chunk)
+				neighbor[axis] += 1 if local else -1
+				chunks.append(tuple(neighbor))
+		for chunk in chunks:
+			if self.chunk_sector(chunk) in self.shownSectors:
+				self.staleChunks.add(chunk)
+
+	def show_chunk(self, chunk, immediate=True):
+		""" Show the blocks of the given chunk, replaces an older mesh of
+		the chunk. The exposed blocks go to `shown`, their faces next to
+		empty space into one vertex list.
 
 		Parameters
 		----------
-		position : tuple of len 3
-			The (x, y, z) position of the block to show.
+		chunk : tuple of len 3
+			The chunk to show.
 		immediate : bool
-			Whether or not to show the block immediately.
+			Whether or not to show the chunk immediately.
 
 		"""
-		texture = self.world[position]
-		self.shown[position] = texture
+		for position in self.shownChunks.pop(chunk, ()):
+			del self.shown[position]
+		padded = self.world.getPadded(chunk)
+		blocks = self.world.getExposedBlocks(chunk, padded)
+		if blocks:
+			self.shown.update(blocks)
+			self.shownChunks[chunk] = [position for position, texture in blocks]
+		if self.greedyMesh:
+			mesh = chunkMesh.buildGreedyMesh(padded)
+		else:
+			mesh = chunkMesh.buildMesh(padded)
 		if immediate:
-			self._show_block(position, MATERIALS[texture])
+			self._show_chunk(chunk, *mesh)
 		else:
-			self._enqueue(self._show_block, position, MATERIALS[texture])
+			self._enqueue(self._show_chunk, chunk, *mesh)
 
-	def _show_block(self, position, texture):
-		""" Private implementation of the `show_block()` method.
+	def _show_chunk(self, chunk, vertices, tex_coords, indices):
+		""" Private implementation of the `show_chunk()` method.
 
 		Parameters
 		----------
-		position : tuple of len 3
-			The (x, y, z) position of the block to show.
-		texture : list of len 3
-			The coordinates of the texture squares. Use `tex_coords()` to
-			generate.
+		chunk : tuple of len 3
+			The chunk to show.
+		vertices, tex_coords, indices : numpy arrays
+			The indexed quads of the chunk, see chunkMesh.indexQuads.
 
 		"""
-		x, y, z = position
-		vertex_data = cube_vertices(x, y, z, CUBE_SIZE)
-		texture_data = list(texture)
-		# create vertex list
-		# FIXME Maybe `add_indexed()` should be used instead
-		self._shown[position] = self.batch.add(24, GL_QUADS, self.group,
-			('v3f/static', vertex_data),
-			('t2f/static', texture_data))
-
-	def hide_block(self, position, immediate=True):
-		""" Hide the block at the given `position`. Hiding does not remove the
-		block from the world.
-
-		Parameters
-		----------
-		position : tuple of len 3
-			The (x, y, z) position of the block to hide.
-		immediate : bool
-			Whether or not to immediately remove the block from the canvas.
+		self._hide_chunk(chunk)
+		if len(indices):
+			count = len(vertices) // 3
+			self._shown[chunk] = self.batch.add_indexed(count, GL_QUADS, ChunkGroup(chunk, self.group),
+				indices.tolist(),
+				(chunkMesh.VERTEX_FORMAT, vertices.tolist()),
+				(chunkMesh.TEX_COORD_FORMAT, tex_coords.tolist()))
+			self.meshBytes[chunk] = count * chunkMesh.VERTEX_BYTES + len(indices) * chunkMesh.INDEX_BYTES
+
+	def hide_chunk(self, chunk, immediate=True):
+		""" Hide the blocks of the given chunk. Hiding does not remove the
+		blocks from the world.
 
 		"""
-		self.shown.pop(position)
+		for position in self.shownChunks.pop(chunk, ()):
+			del self.shown[position]
 		if immediate:
-			self._hide_block(position)
+			self._hide_chunk(chunk)
 		else:
-			self._enqueue(self._hide_block, position)
+			self._enqueue(self._hide_chunk, chunk)
+
+	def _hide_chunk(self, chunk):
+		""" Private implementation of the 'hide_chunk()` method.
+
+		"""
+		vertex_list = self._shown.pop(chunk, None)
+		if vertex_list is not None:
+			vertex_list.delete()
+			del self.meshBytes[chunk]
+
+	def mesh_report(self):
+		""" Returns a line about the bytes uploaded for the shown chunks,
+		compared to one 24 vertex list per shown block.
+
+		"""
+		blocks = max(len(self.shown), 1)
+		uploaded = sum(self.meshBytes.itervalues())
+		unindexed = len(self.shown) * chunkMesh.BLOCK_BYTES_UNINDEXED
+		return "mesh: %d bytes for %d shown blocks (%.1f per block), one vertex list per block: %d bytes (%d per block)" % (
+			uploaded, len(self.shown), uploaded / float(blocks), unindexed, chunkMesh.BLOCK_BYTES_UNINDEXED)
+
+	def rebuild_stale_chunks(self):
+		""" Rebuild the meshes of the chunks changed since the last frame.
+
+		"""
+		for chunk in self.staleChunks:
+			# behind older queued meshes of the chunk if there are any
+			self.show_chunk(chunk, not self.queue)
+		self.staleChunks.clear()
 
-	def _hide_block(self, position):
-		""" Private implementation of the 'hide_block()` method.
+	def sector_chunks(self, sector):
+		""" Returns the chunks with blocks in the given sector.
 
 		"""
-		self._shown.pop(position).delete()
+		sx, sy, sz = sector
+		return [chunk for chunk in self.world.getChunks()
+			if chunk[0] // SECTOR_CHUNKS == sx and chunk[2] // SECTOR_CHUNKS == sz]
 
 	def show_sector(self, sector):
 		""" Ensure all blocks in the given sector that should be shown are
 		drawn to the canvas.
 
 		"""
-		for position in self.sectors.get(sector, []):
-			if position not in self.shown and self.exposed(position):
-				self.show_block(position, False)
+		self.shownSectors.add(sector)
+		for chunk in self.sector_chunks(sector):
+			self.show_chunk(chunk, False)
 
 	def hide_sector(self, sector):
 		""" Ensure all blocks in the given sector that should be hidden are
 		removed from the canvas.
 
 		"""
-		for position in self.sectors.get(sector, []):
-			if position in self.shown:
-				self.hide_block(position, False)
+		self.shownSectors.discard(sector)
+		for chunk in [chunk for chunk in self.shownChunks if self.chunk_sector(chunk) == sector]:
+			self.hide_chunk(chunk, False)
 
 	def change_sectors(self, before, after):
 		""" Move from sector `before` to sector `after`. A sector is a
@@ -434,10 +623,11 @@ class Model(object):
 	def process_queue(self):
 		""" Process the entire queue while taking periodic breaks. This allows
 		the game loop to run smoothly. The queue contains calls to
-		_show_block() and _hide_block() so this method should be called if
-		add_block() or remove_block() was called with immediate=False
+		_show_chunk() and _hide_chunk(). The chunks edited with add_block()
+		or remove_block() since the last call are rebuilt first.
 
 		"""
+		self.rebuild_stale_chunks()
 		start = time.clock()
 		while self.queue and time.clock() - start < 1 / 60.0:
 			self._dequeue()
@@ -446,5 +636,6 @@ class Model(object):
 		""" Process the entire queue with no breaks.
 
 		"""
+		self.rebuild_stale_chunks()
 		while self.queue:
 			self._dequeue()
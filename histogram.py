@@ -0,0 +1,186 @@
+#!/usr/bin/python
+""" Intensity histogram of a whole study.
+
+dcm2save.py stores it next to the converted slices, with it the voxel count
+and the material breakdown of any minVal/maxVal/materialSwitch can be
+answered without converting the study again:
+
+	python histogram.py tmp/ minVal=130 maxVal=134 materialSwitch=15
+"""
+import os
+import sys
+import numpy
+import multiTimer
+import thresholdEngine
+
+
+def getSidecarPath(source, direct=False, rescale=True):
+	""" Returns the path of the histogram file for the given source folder
+	(or single file in heightMap mode). The DICOM values differ from the
+	pnm values, so every mode has its own file.
+	"""
+	name = "histogram.npz"
+	if direct and rescale:
+		name = "histogram.dicom.npz"
+	elif direct:
+		name = "histogram.dicomraw.npz"
+
+	if os.path.isdir(source):
+		return os.path.join(source, name)
+	folder, fileName = os.path.split(source)
+	return os.path.join(folder, name.replace("histogram.", "histogram." + fileName + ".", 1))
+
+
+class intensityHistogram(object):
+	""" Counts every gray value, `counts[i]` is the count of value `offset + i`.
+	"""
+	def __init__(self):
+		self.offset = 0
+		self.counts = numpy.zeros(0, dtype=numpy.int64)
+
+	def add(self, values):
+		""" Counts all values of a numpy array (one slice or a whole stack).
+		"""
+		if not len(values):
+			return
+		lo = int(values.min())
+		hi = int(values.max())
+		self._grow(lo, hi)
+		start = lo - self.offset
+		self.counts[start:start + hi - lo + 1] += numpy.bincount((values - lo).ravel(), minlength=hi - lo + 1)
+
+	def merge(self, other):
+		""" Adds the counts of another histogram, e.g. from a worker process.
+		"""
+		if not other.totalValues():
+			return
+		lo, hi = other.minValue(), other.maxValue()
+		self._grow(lo, hi)
+		start = lo - self.offset
+		otherStart = lo - other.offset
+		self.counts[start:start + hi - lo + 1] += other.counts[otherStart:otherStart + hi - lo + 1]
+
+	def _grow(self, lo, hi):
+		""" Makes sure the values from lo to hi have a bin.
+		"""
+		if not len(self.counts):
+			self.offset = lo
+			self.counts = numpy.zeros(hi - lo + 1, dtype=numpy.int64)
+			return
+		newOffset = min(lo, self.offset)
+		newEnd = max(hi, self.offset + len(self.counts) - 1)
+		if newOffset == self.offset and newEnd == self.offset + len(self.counts) - 1:
+			return
+		counts = numpy.zeros(newEnd - newOffset + 1, dtype=numpy.int64)
+		counts[self.offset - newOffset:self.offset - newOffset + len(self.counts)] = self.counts
+		self.offset = newOffset
+		self.counts = counts
+
+	def totalValues(self):
+		return int(self.counts.sum())
+
+	def minValue(self):
+		""" Returns the smallest counted value, None for an empty histogram.
+		"""
+		used = numpy.flatnonzero(self.counts)
+		if not len(used):
+			return None
+		return self.offset + int(used[0])
+
+	def maxValue(self):
+		""" Returns the biggest counted value, None for an empty histogram.
+		"""
+		used = numpy.flatnonzero(self.counts)
+		if not len(used):
+			return None
+		return self.offset + int(used[-1])
+
+	def getRange(self, minVal, maxVal):
+		""" Returns the values from minVal to maxVal that have a bin and their counts.
+		"""
+		start = max(minVal - self.offset, 0)
+		end = min(maxVal - self.offset + 1, len(self.counts))
+		if end <= start:
+			return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+		return numpy.arange(start, end) + self.offset, self.counts[start:end]
+
+	def countRange(self, minVal, maxVal):
+		""" Returns the number of values from minVal to maxVal.
+		"""
+		return int(self.getRange(minVal, maxVal)[1].sum())
+
+	def query(self, engine):
+		""" Returns what a conversion with the settings of the given
+		thresholdEngine would produce:
+		{"accepted": pixels in range, "voxels": voxels written,
+		"materials": {material index: voxel count}}
+		"""
+		values, counts = self.getRange(engine.minVal, engine.maxVal)
+		voxelCounts = counts
+		if engine.heightMap:
+			# every pixel becomes a column of (value - minVal) voxels
+			voxelCounts = counts * (values - engine.minVal)
+
+		materials = {}
+		if len(values):
+			perMaterial = numpy.bincount(engine.getMaterials(values), weights=voxelCounts)
+			for material in numpy.flatnonzero(perMaterial):
+				materials[int(material)] = int(perMaterial[material])
+
+		return {"accepted": int(counts.sum()), "voxels": int(voxelCounts.sum()), "materials": materials}
+
+	def save(self, path):
+		fh = open(path, 'wb')
+		numpy.savez(fh, offset=numpy.array([self.offset]), counts=self.counts)
+		fh.close()
+
+	def load(self, path):
+		data = numpy.load(path)
+		self.offset = int(data["offset"][0])
+		self.counts = data["counts"].astype(numpy.int64)
+		data.close()
+
+
+if __name__ == '__main__':
+	source = "./tmp"
+	if len(sys.argv) > 1:
+		source = sys.argv[1]
+
+	minVal = 1
+	maxVal = 4
+	materialSwitch = 15
+	heightMap = False
+	direct = False
+	rescale = True
+	for arg in sys.argv:
+		if arg.startswith("minVal="):
+			minVal = int(arg.replace("minVal=", ""))
+		elif arg.startswith("maxVal="):
+			maxVal = int(arg.replace("maxVal=", ""))
+		elif arg.startswith("materialSwitch="):
+			materialSwitch = int(arg.replace("materialSwitch=", ""))
+		elif arg.startswith("heightMap="):
+			heightMap = bool(int(arg.replace("heightMap=", "")))
+		elif arg.startswith("direct="):
+			direct = bool(int(arg.replace("direct=", "")))
+		elif arg.startswith("rescale="):
+			rescale = bool(int(arg.replace("rescale=", "")))
+
+	path = getSidecarPath(source, direct, rescale)
+	if not os.path.exists(path):
+		print "no histogram found, create it with: python dcm2save.py", source, "histogramOnly=1"
+		sys.exit(1)
+
+	mt = multiTimer.multiTimer()
+	mt.start("query")
+	hist = intensityHistogram()
+	hist.load(path)
+	result = hist.query(thresholdEngine.thresholdEngine(minVal, maxVal, materialSwitch, heightMap=heightMap))
+	mt.stop("query")
+
+	print "values:", hist.minValue(), "-", hist.maxValue()
+	print "accepted values:", result["accepted"], "/", hist.totalValues()
+	print "voxels:", result["voxels"]
+	for material in sorted(result["materials"]):
+		print "material", material, ":", result["materials"][material]
+	print "duration: %.2f ms" % (mt.duration("query") * 1000)
@@ -0,0 +1,83 @@
+import numpy
+
+
+def reduceBlocks(stack, factor, mode="mean"):
+	""" Reduces a stack of slices (z, rows, columns) by `factor` on every
+	axis, every factor*factor*factor block becomes one value.
+
+	Parameters
+	----------
+	stack : numpy array of 3 dimensions
+		up to `factor` slices, a stack with less slices (end of the series)
+		is reduced over the slices it has
+	factor : int
+		2, 4, 8, ...
+	mode : string
+		"mean" for the rounded mean of the block, "majority" for the most
+		frequent value of the block (the smallest one on a tie)
+
+	Returns
+	-------
+	reduced slice : numpy array of 2 dimensions
+	"""
+	depth, rows, columns = stack.shape
+	# incomplete blocks at the border are filled up with the border values
+	padRows = -rows % factor
+	padColumns = -columns % factor
+	if padRows or padColumns:
+		stack = numpy.pad(stack, ((0, 0), (0, padRows), (0, padColumns)), mode="edge")
+	rows = (rows + padRows) // factor
+	columns = (columns + padColumns) // factor
+
+	# (rows, columns, values of the block)
+	blocks = stack.reshape(depth, rows, factor, columns, factor).transpose(1, 3, 0, 2, 4).reshape(rows, columns, -1)
+	if mode == "majority":
+		return getMajority(blocks.reshape(rows * columns, -1)).reshape(rows, columns)
+	return numpy.rint(blocks.mean(axis=-1)).astype(numpy.int64)
+
+def getMajority(blocks):
+	""" Returns the most frequent value of every row of a 2 dimensional array.
+	"""
+	count, size = blocks.shape
+	blocks = numpy.sort(blocks, axis=1)
+	position = numpy.arange(size)
+	isRunStart = numpy.ones(blocks.shape, dtype=bool)
+	isRunStart[:, 1:] = blocks[:, 1:] != blocks[:, :-1]
+	# length of the run of equal values up to every position
+	runStart = numpy.maximum.accumulate(numpy.where(isRunStart, position, 0), axis=1)
+	runLength = position - runStart + 1
+	return blocks[numpy.arange(count), runLength.argmax(axis=1)]
+
+
+class pyramidLevel(object):
+	""" Collects the slices of a series and returns a reduced slice for
+	every `factor` slices.
+	"""
+	def __init__(self, factor, mode="mean"):
+		self.factor = factor
+		self.mode = mode
+		self.slices = []
+		# number of reduced slices returned so far, the z index of the next one
+		self.count = 0
+
+	def addSlice(self, image):
+		""" Adds a full resolution slice (rows, columns), returns the next
+		reduced slice when `factor` slices are collected, None otherwise.
+		"""
+		if self.slices and image.shape != self.slices[0].shape:
+			raise ValueError("all slices need the same size to build levels")
+		self.slices.append(image)
+		if len(self.slices) < self.factor:
+			return None
+		return self.flush()
+
+	def flush(self):
+		""" Returns the reduced slice of the collected slices (None if
+		there are none), used for the rest at the end of a series.
+		"""
+		if not self.slices:
+			return None
+		reduced = reduceBlocks(numpy.array(self.slices), self.factor, self.mode)
+		self.slices = []
+		self.count += 1
+		return reduced
@@ -0,0 +1,223 @@
+""" Region save files: the world in fixed size chunks.
+
+Every chunk (chunkSize blocks on every axis) is stored as a dense uint8
+array (material + 1, 0 is empty) compressed with zlib on its own. A table at
+the head of the file tells where every chunk is, so single chunks can be
+read without touching the rest of the file and changed chunks can be
+written without rewriting the others.
+
+	header | table (capacity entries) | chunk data ...
+"""
+import os
+import zlib
+import numpy
+
+REGION_MAGIC = "DICR"
+REGION_VERSION = 1
+# magic, version, chunk size, table capacity, used table entries
+REGION_HEADER = numpy.dtype([("magic", "S4"), ("version", "<u2"), ("chunkSize", "<u2"), ("capacity", "<u4"), ("used", "<u4")])
+# chunk position, offset in the file, compressed length, allocated size, number of blocks
+REGION_ENTRY = numpy.dtype([("cx", "<i4"), ("cy", "<i4"), ("cz", "<i4"), ("offset", "<u8"), ("length", "<u4"), ("size", "<u4"), ("count", "<u4")])
+
+# table entries of a new file, the file is rewritten with twice the entries when they run out
+DEFAULT_CAPACITY = 1024
+
+
+def isRegionFile(path):
+	if not os.path.exists(path):
+		return False
+	fh = open(path, 'rb')
+	magic = fh.read(len(REGION_MAGIC))
+	fh.close()
+	return magic == REGION_MAGIC
+
+
+def replaceFile(part, dest):
+	""" Moves the completely written `part` to `dest`. os.rename replaces
+	`dest` atomically on POSIX. On Windows it fails if `dest` exists, the
+	old file becomes <dest>.bak until the new one is in place.
+	"""
+	if os.name != "nt" or not os.path.exists(dest):
+		os.rename(part, dest)
+		return
+	backup = dest + ".bak"
+	if os.path.exists(backup):
+		os.remove(backup)
+	os.rename(dest, backup)
+	os.rename(part, dest)
+	os.remove(backup)
+
+
+class regionFile(object):
+	""" Reads and writes the chunks of a region file.
+
+	Parameters
+	----------
+	path : string
+		The region file, created on the first write if it does not exist.
+	chunkSize : int
+		Size of the chunks of a new file, an existing file keeps its own.
+	"""
+	def __init__(self, path, chunkSize=32):
+		self.path = path
+		self.chunkSize = chunkSize
+		self.capacity = DEFAULT_CAPACITY
+		# chunk position: [offset, length, size, count]
+		self.table = {}
+		if isRegionFile(path):
+			self.readTable()
+
+	def readTable(self):
+		fh = open(self.path, 'rb')
+		header = numpy.fromfile(fh, dtype=REGION_HEADER, count=1)[0]
+		if header["version"] != REGION_VERSION:
+			fh.close()
+			raise ValueError("unknown region file version %d" % header["version"])
+		self.chunkSize = int(header["chunkSize"])
+		self.capacity = int(header["capacity"])
+		entries = numpy.fromfile(fh, dtype=REGION_ENTRY, count=int(header["used"]))
+		fh.close()
+		self.table = {}
+		for entry in entries.tolist():
+			cx, cy, cz, offset, length, size, count = entry
+			self.table[(cx, cy, cz)] = [offset, length, size, count]
+
+	def getDataStart(self):
+		""" Returns the offset of the first byte after the table.
+		"""
+		return REGION_HEADER.itemsize + self.capacity * REGION_ENTRY.itemsize
+
+	def getChunks(self):
+		return self.table.keys()
+
+	def getChunksInBox(self, box):
+		""" Returns the stored chunks intersecting the box (x0, y0, z0, x1, y1, z1),
+		given in block positions, all inclusive.
+		"""
+		x0, y0, z0, x1, y1, z1 = [value // self.chunkSize for value in box]
+		return [chunk for chunk in self.table
+			if x0 <= chunk[0] <= x1 and y0 <= chunk[1] <= y1 and z0 <= chunk[2] <= z1]
+
+	def getChunksNear(self, position, radius):
+		""" Returns the stored chunks within `radius` chunks of a block position.
+		"""
+		cx, cy, cz = [int(value // self.chunkSize) for value in position]
+		return [chunk for chunk in self.table
+			if (chunk[0] - cx) ** 2 + (chunk[1] - cy) ** 2 + (chunk[2] - cz) ** 2 <= radius ** 2]
+
+	def readChunk(self, chunk, fh=None):
+		""" Returns the x, y, z and material arrays of the blocks of a chunk.
+		"""
+		offset, length, size, count = self.table[chunk]
+		ownHandle = fh is None
+		if ownHandle:
+			fh = open(self.path, 'rb')
+		fh.seek(offset)
+		data = fh.read(length)
+		if ownHandle:
+			fh.close()
+
+		dense = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8).reshape((self.chunkSize,) * 3)
+		xs, ys, zs = numpy.nonzero(dense)
+		materials = dense[xs, ys, zs].astype(numpy.int64) - 1
+		return xs + chunk[0] * self.chunkSize, ys + chunk[1] * self.chunkSize, zs + chunk[2] * self.chunkSize, materials
+
+	def readChunks(self, chunks):
+		""" Yields (chunk, (x, y, z, material arrays)) for the given chunks,
+		in file order.
+		"""
+		fh = open(self.path, 'rb')
+		try:
+			for chunk in sorted(chunks, key=lambda chunk: self.table[chunk][0]):
+				yield chunk, self.readChunk(chunk, fh)
+		finally:
+			fh.close()
+
+	def packChunk(self, chunk, blocks):
+		""" Returns the compressed data of a chunk, `blocks` maps the positions
+		in the chunk to their material.
+		"""
+		dense = numpy.zeros((self.chunkSize,) * 3, dtype=numpy.uint8)
+		if blocks:
+			positions = numpy.array(blocks.keys(), dtype=numpy.int64) - numpy.array(chunk) * self.chunkSize
+			dense[positions[:, 0], positions[:, 1], positions[:, 2]] = numpy.array(blocks.values(), dtype=numpy.int64) + 1
+		return zlib.compress(dense.tostring())
+
+	def writeChunks(self, chunks):
+		""" Writes the given chunks {chunk: {position: material}}, all other
+		chunks of the file stay as they are. An empty chunk is removed.
+		"""
+		if not isRegionFile(self.path):
+			self.rewrite({})
+
+		packed = {}
+		for chunk, blocks in chunks.iteritems():
+			if blocks:
+				packed[chunk] = (self.packChunk(chunk, blocks), len(blocks))
+			else:
+				self.table.pop(chunk, None)
+
+		if len(set(self.table) | set(packed)) > self.capacity:
+			# no room in the table, move everything behind a bigger one
+			self.rewrite(packed)
+			return
+
+		fh = open(self.path, 'r+b')
+		fh.seek(0, os.SEEK_END)
+		# a file without chunks ends at the table
+		end = max(fh.tell(), self.getDataStart())
+		for chunk, (data, count) in packed.iteritems():
+			entry = self.table.get(chunk)
+			if entry is not None and len(data) <= entry[2]:
+				# fits into its old place
+				offset, size = entry[0], entry[2]
+			else:
+				# grown chunks move to the end, with some room to grow again
+				offset, size = end, len(data) + len(data) // 4
+				end += size
+			fh.seek(offset)
+			fh.write(data)
+			self.table[chunk] = [offset, len(data), size, count]
+		self.writeTable(fh)
+		fh.close()
+
+	def rewrite(self, packed):
+		""" Writes a new compact file with all stored chunks plus the
+		`packed` ones {chunk: (data, count)}.
+		"""
+		chunks = {}
+		if isRegionFile(self.path):
+			fh = open(self.path, 'rb')
+			for chunk, (offset, length, size, count) in self.table.iteritems():
+				if chunk not in packed:
+					fh.seek(offset)
+					chunks[chunk] = (fh.read(length), count)
+			fh.close()
+		chunks.update(packed)
+
+		while self.capacity < len(chunks):
+			self.capacity *= 2
+		self.table = {}
+		fh = open(self.path + ".part", 'wb')
+		fh.seek(self.getDataStart())
+		for chunk in sorted(chunks):
+			data, count = chunks[chunk]
+			self.table[chunk] = [fh.tell(), len(data), len(data), count]
+			fh.write(data)
+		self.writeTable(fh)
+		fh.close()
+		replaceFile(self.path + ".part", self.path)
+
+	def writeTable(self, fh):
+		header = numpy.zeros(1, dtype=REGION_HEADER)
+		header["magic"] = REGION_MAGIC
+		header["version"] = REGION_VERSION
+		header["chunkSize"] = self.chunkSize
+		header["capacity"] = self.capacity
+		header["used"] = len(self.table)
+		entries = numpy.zeros(len(self.table), dtype=REGION_ENTRY)
+		for i, chunk in enumerate(sorted(self.table)):
+			entries[i] = chunk + tuple(self.table[chunk])
+		fh.seek(0)
+		fh.write(header.tostring())
+		fh.write(entries.tostring())
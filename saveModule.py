@@ -2,21 +2,219 @@ import engine as main  # we need the blocktypes from the main program
 import json
 import os
 import sys
-from time import gmtime, strftime
+import itertools
+import string
+import threading
+import multiprocessing
+import Queue
+import zlib
+import bz2
+import gzip
+from multiprocessing.pool import ThreadPool
+from time import gmtime, strftime, time
+import numpy
 import stlWriter
 import blockWork
+import regionFile
+import editJournal
+import chunkWorld
+
+# binary saves start with this, everything else is read as a text save
+BINARY_MAGIC = "DICV"
+BINARY_VERSION = 1
+# magic, version, codec (0 for uncompressed columns), number of voxels
+BINARY_HEADER = numpy.dtype([("magic", "S4"), ("version", "<u2"), ("flags", "<u2"), ("count", "<u8")])
+
+# compressed binary saves: the voxels sorted by position in blocks of this
+# many voxels, every block delta coded and compressed on its own
+COMPRESSED_BLOCK_VOXELS = 1024 * 1024
+# voxels and compressed bytes of a block, the table follows the header
+BLOCK_ENTRY = numpy.dtype([("count", "<u4"), ("length", "<u4")])
+
+# compress= codecs: header flag, compress, decompress
+CODECS = {
+	"zlib": (1, zlib.compress, zlib.decompress),
+	"bz2": (2, bz2.compress, bz2.decompress),
+}
+try:
+	try:
+		import lzma
+	except ImportError:
+		from backports import lzma
+	CODECS["lzma"] = (3, lzma.compress, lzma.decompress)
+except ImportError:
+	# python 2 has lzma only with backports.lzma
+	pass
+CODEC_NAMES = dict((codec[0], name) for name, codec in CODECS.items())
+
+# text saves compressed with gzip start with this
+GZIP_MAGIC = "\x1f\x8b"
+
+
+# text saves are read in blocks of this many bytes
+TEXT_BLOCK_SIZE = 16 * 1024 * 1024
+# "[x, y, z]:material" becomes "x  y  z  material" for numpy.fromstring
+TEXT_SEPARATORS = string.maketrans("[],:", "    ")
+
+
+def parseSaveLines(data):
+	""" Parses complete lines of a text save in bulk.
+
+	Parameters
+	----------
+	data : string
+		Whole lines "[x, y, z]:material" or "[x, y0, z, y1]:material"
+		(heightMap columns), the last one ending with a newline.
+
+	Returns
+	-------
+	voxels : numpy array of shape (n, 4), x, y, z, material
+	runs : numpy array of shape (m, 5), x, y0, z, y1, material
+	skipped : int
+		Number of lines with an unexpected number of values.
+
+	"""
+	if not data.strip():
+		# numpy.fromstring reads a 0 from whitespace only
+		return numpy.zeros((0, 4), dtype=numpy.int64), numpy.zeros((0, 5), dtype=numpy.int64), 0
+	values = numpy.fromstring(data.translate(TEXT_SEPARATORS), dtype=numpy.int64, sep=" ")
+	chars = numpy.frombuffer(data, dtype=numpy.uint8)
+	newlines = numpy.flatnonzero(chars == ord("\n"))
+	commas = numpy.flatnonzero(chars == ord(","))
+	# a line with n coordinates has n - 1 commas and one material, empty lines have no commas
+	commaCounts = numpy.diff(numpy.searchsorted(commas, numpy.concatenate(([0], newlines + 1))))
+	tokenCounts = commaCounts[commaCounts > 0] + 2
+	if tokenCounts.sum() != len(values):
+		raise ValueError("broken line in text save")
+	
+	if (tokenCounts == 4).all():
+		# no heightMap columns, the common case
+		return values.reshape(-1, 4), numpy.zeros((0, 5), dtype=numpy.int64), 0
+	starts = numpy.cumsum(tokenCounts) - tokenCounts
+	voxels = values[starts[tokenCounts == 4][:, None] + numpy.arange(4)]
+	runs = values[starts[tokenCounts == 5][:, None] + numpy.arange(5)]
+	return voxels, runs, len(tokenCounts) - len(voxels) - len(runs)
+
+def truncateRuns(runs, count):
+	""" Returns the heightMap columns (x, y0, z, y1, material) cut after
+	`count` voxels, the last column is shortened if needed.
+	"""
+	heights = runs[:, 3] - runs[:, 1] + 1
+	ends = numpy.cumsum(heights)
+	if not len(runs) or ends[-1] <= count:
+		return runs
+	# the first column that does not fit completely
+	cut = int(numpy.searchsorted(ends, count, side="right"))
+	left = count - (int(ends[cut - 1]) if cut else 0)
+	if not left:
+		return runs[:cut]
+	runs = numpy.array(runs[:cut + 1])
+	runs[cut, 3] = runs[cut, 1] + left - 1
+	return runs
+
+def packBlock(job):
+	""" delta codes and compresses one block of sorted voxels, runs in the
+	compression threads (zlib, bz2 and lzma release the GIL)
+
+	Parameters
+	----------
+	job : tuple of len 3
+		(positions as (n, 3) array, materials, codec name)
+
+	Returns
+	-------
+	compressed block : string
+	"""
+	positions, materials, codec = job
+	# differences to the previous voxel are mostly 0 and 1, int16 wraps around both ways
+	deltas = numpy.diff(positions.astype(numpy.int16), axis=0)
+	columns = numpy.concatenate((positions[:1].astype(numpy.int16), deltas)).T.astype("<i2")
+	return CODECS[codec][1](columns.tostring() + materials.astype(numpy.uint8).tostring())
+
+def unpackBlock(data, count, codec):
+	""" Returns the positions ((n, 3) array) and materials of a block from packBlock.
+	"""
+	data = CODECS[codec][2](data)
+	columns = numpy.frombuffer(data, dtype="<i2", count=count * 3).reshape(3, count)
+	positions = numpy.cumsum(columns, axis=1, dtype=numpy.int16).T.astype(numpy.int64)
+	materials = numpy.frombuffer(data, dtype=numpy.uint8, offset=count * 6)
+	return positions, materials
+
+def getBinaryColumns(count):
+	""" Returns the dtype of the columns after the header of a binary save:
+	all x, all y, all z (int16) and all materials (uint8).
+	"""
+	return numpy.dtype([("x", "<i2", (count,)), ("y", "<i2", (count,)), ("z", "<i2", (count,)), ("material", "u1", (count,))])
+
+
+
+class worldSnapshot(object):
+	""" Copy of the parts of a model saves and exports need, written in a
+	background thread while the editor goes on changing the model.
+	"""
+	def __init__(self, model):
+		# a copy in memory, copy on write for an mmapWorld
+		self.world = model.world.snapshot()
+		self.shown = dict.fromkeys(model.shown)
+		self.dirtyChunks = set(model.dirtyChunks)
+		self.runs = list(model.runs)
+		self.editedColumns = set(model.editedColumns)
+		self.unloadedEdits = dict((chunk, dict(edits)) for chunk, edits in model.unloadedEdits.iteritems())
+	
+	def release(self):
+		if isinstance(self.world, chunkWorld.mmapSnapshot):
+			self.world.release()
 
 		
 class saveModule(object):
 	def __init__(self):		
 		self.saveFile = 'quicksave.sav'
 		self.saveFolder = "saves"
+		# "binary", "region" or "text" (the old one json line per voxel format)
+		self.saveFormat = "binary"
+		# compress binary saves with "zlib", "bz2" or "lzma" (text saves always with gzip)
+		self.compression = None
+		# region saves: load only the chunks in this box (x0, y0, z0, x1, y1, z1)
+		self.loadBox = None
+		# region saves: load only the chunks within this many chunks of the player
+		self.loadRadius = None
+		# the region file the world was loaded from and its chunks loaded so far
+		self.region = None
+		self.loadedChunks = set()
+		# F5 only flushes the journal of the edits, "journal=0" writes the whole save every time
+		self.useJournal = True
+		self.journal = None
+		# the journal is compacted into a new save when it has more records
+		self.compactRecords = 100000
+		# the save or export running in the background, see startTask
+		self.task = None
+		# progress messages of a background task go here instead of only to the console
+		self.progress = None
+		# time to clear the last task message from model.notification
+		self.notificationEnd = None
+		# folder for the chunk files of an out of core world, see chunkWorld
+		self.worldFolder = None
 		if len(sys.argv) > 1:
 			for arg in sys.argv:
 				if arg.startswith("savefile="):
 					self.saveFile = arg.replace("savefile=", "")
 				elif arg.startswith("sf="):
 					self.saveFile = arg.replace("sf=", "")
+				elif arg.startswith("saveFormat="):
+					self.saveFormat = arg.replace("saveFormat=", "")
+				elif arg.startswith("loadBox="):
+					self.loadBox = [int(value) for value in arg.replace("loadBox=", "").split(",")]
+				elif arg.startswith("loadRadius="):
+					self.loadRadius = int(arg.replace("loadRadius=", ""))
+				elif arg.startswith("compress="):
+					self.compression = arg.replace("compress=", "")
+					if not self.compression in CODECS:
+						self.printStuff("unknown compression " + self.compression + ", use one of " + ", ".join(sorted(CODECS)))
+						self.compression = None
+				elif arg.startswith("journal="):
+					self.useJournal = bool(int(arg.replace("journal=", "")))
+				elif arg.startswith("mmapWorld="):
+					self.worldFolder = arg.replace("mmapWorld=", "")
 		
 		self.printStuff("working with file: " + self.getSaveDest())
 				
@@ -25,60 +223,493 @@ class saveModule(object):
 		
 		# max voxels to load
 		self.maxVoxels = 10000000
+		if self.worldFolder is not None:
+			# the world is on the disk, load everything
+			self.maxVoxels = sys.maxint
 		
 	def printStuff(self, txt):
 		print(strftime("%d-%m-%Y %H:%M:%S|", gmtime()) + str(txt) ) 
+		if self.progress is not None:
+			self.progress.put(("progress", str(txt)))
 	
 	def getSaveDest(self):
 		return os.path.join(self.saveFolder, self.saveFile)
 	
+	def getJournalPath(self):
+		return self.getSaveDest() + ".journal"
+	
 	def hasSaveFile(self):
+		backup = self.getSaveDest() + ".bak"
+		if not os.path.exists(self.getSaveDest()) and os.path.exists(backup):
+			# regionFile.replaceFile on Windows did not finish
+			os.rename(backup, self.getSaveDest())
 		if os.path.exists(self.getSaveDest()):
 			return True
 		else:
 			return False
 	
+	def isBinarySave(self):
+		fh = open(self.getSaveDest(), 'rb')
+		magic = fh.read(len(BINARY_MAGIC))
+		fh.close()
+		return magic == BINARY_MAGIC
+	
 	def loadWorld(self, model):
-		self.printStuff('start loading...') 
-		fh = open(self.getSaveDest(), 'r')
-		worldMod = fh.read()
+		if regionFile.isRegionFile(self.getSaveDest()):
+			self.loadWorldRegion(model)
+		elif self.isBinarySave():
+			self.loadWorldBinary(model)
+		else:
+			self.loadWorldText(model)
+		# nothing changed yet
+		model.dirtyChunks.clear()
+		
+		# edits since the last compaction, an unfinished compaction first
+		records = editJournal.replayJournal(model, self.getJournalPath() + ".old")
+		records += editJournal.replayJournal(model, self.getJournalPath())
+		if records:
+			self.printStuff("replayed " + str(records) + " edits from the journal")
+		if self.useJournal:
+			self.openJournal(model)
+			if self.journal.records > self.compactRecords:
+				self.writeInBackground(model)
+	
+	def removeJournal(self):
+		for path in (self.getJournalPath(), self.getJournalPath() + ".old"):
+			if os.path.exists(path):
+				os.remove(path)
+	
+	def openJournal(self, model):
+		""" starts writing the edits of the model into the journal
+		"""
+		self.journal = editJournal.editJournal(self.getJournalPath())
+		model.journal = self.journal
+	
+	def loadWorldRegion(self, model):
+		self.printStuff('start loading region...')
+		self.region = regionFile.regionFile(self.getSaveDest())
+		if self.region.chunkSize != main.CHUNK_SIZE:
+			raise ValueError("region file with chunk size %d, expected %d" % (self.region.chunkSize, main.CHUNK_SIZE))
+		# a binary or text save would lose the chunks that are not loaded
+		self.saveFormat = "region"
+		
+		if self.loadRadius is not None:
+			# the chunks around the player are loaded as it moves (loadChunksNear)
+			self.printStuff('loading chunks near the player')
+			return
+		chunks = self.region.getChunks()
+		if self.loadBox is not None:
+			chunks = self.region.getChunksInBox(self.loadBox)
+		count = self.loadChunks(model, chunks)
+		self.printStuff("loaded " + str(count) + " voxels in " + str(len(chunks)) + "/" + str(len(self.region.getChunks())) + " chunks")
+		self.printStuff('loading completed')
+	
+	def loadChunks(self, model, chunks):
+		""" adds the blocks of the given region chunks to the model, chunks
+		that are already loaded are skipped, returns the number of blocks
+		"""
+		chunks = [chunk for chunk in chunks if not chunk in self.loadedChunks]
+		if not chunks:
+			return 0
+		# a background save may be writing these chunks right now
+		self.waitForTask(model)
+		dirty = set(model.dirtyChunks)
+		count = 0
+		for chunk, (xs, ys, zs, materials) in self.region.readChunks(chunks):
+			positions = numpy.column_stack((xs, ys, zs))
+			edits = model.unloadedEdits.pop(chunk, None)
+			if edits:
+				# the blocks edited before the chunk was loaded stay as they are
+				keep = numpy.array([not position in edits for position in itertools.izip(xs.tolist(), ys.tolist(), zs.tolist())], dtype=bool)
+				positions, materials = positions[keep], materials[keep]
+			model.add_blocks(positions, materials)
+			count += len(materials)
+			self.loadedChunks.add(chunk)
+		# loaded chunks are the same as on disk
+		model.dirtyChunks.difference_update(set(chunks) - dirty)
+		return count
+	
+	def loadChunksNear(self, model, position):
+		""" loads the region chunks within loadRadius of the player position,
+		does nothing for other saves or without loadRadius
+		"""
+		if self.region is None or self.loadRadius is None:
+			return 0
+		return self.loadChunks(model, self.region.getChunksNear(position, self.loadRadius))
+	
+	def isChunkLoaded(self, chunk):
+		""" False for a chunk of the region file that is not loaded yet, the
+		model keeps the edits there in model.unloadedEdits
+		"""
+		return self.region is None or chunk in self.loadedChunks or not chunk in self.region.table
+	
+	def getChunkBlocks(self, model, chunks):
+		""" returns {chunk: {position: material}} for the given chunks, the
+		chunks that are not loaded are read from the region file and get
+		the edits on top
+		"""
+		chunkBlocks = dict((chunk, model.world.getChunkBlocks(chunk)) for chunk in chunks if not chunk in model.unloadedEdits)
+		edited = [chunk for chunk in chunks if chunk in model.unloadedEdits]
+		if not edited:
+			return chunkBlocks
+		for chunk, (xs, ys, zs, materials) in self.region.readChunks([chunk for chunk in edited if chunk in self.region.table]):
+			chunkBlocks[chunk] = dict(itertools.izip(itertools.izip(xs.tolist(), ys.tolist(), zs.tolist()), materials.tolist()))
+		for chunk in edited:
+			blocks = chunkBlocks.setdefault(chunk, {})
+			for position, material in model.unloadedEdits[chunk].iteritems():
+				if material is None:
+					blocks.pop(position, None)
+				else:
+					blocks[position] = material
+		return chunkBlocks
+	
+	def loadWorldBinary(self, model):
+		self.printStuff('start loading binary...')
+		fh = open(self.getSaveDest(), 'rb')
+		header = numpy.fromfile(fh, dtype=BINARY_HEADER, count=1)[0]
+		if header["version"] != BINARY_VERSION:
+			fh.close()
+			raise ValueError("unknown save version %d" % header["version"])
+		count = int(header["count"])
+		if header["flags"]:
+			self.loadBinaryBlocks(model, fh, count, CODEC_NAMES[int(header["flags"])])
+			fh.close()
+			return
+		# all columns in one read
+		columns = numpy.fromfile(fh, dtype=getBinaryColumns(count), count=1)[0]
 		fh.close()
 		
-		worldMod = worldMod.split('\n')
+		# just in case you dont want to exhaust memory!
+		count = min(count, self.maxVoxels)
+		positions = numpy.column_stack((columns["x"][:count], columns["y"][:count], columns["z"][:count]))
+		model.add_blocks(positions, columns["material"][:count])
 		
-		lineCounter = 0
-		lineCounterTotal = 0
-		linesTotal = len(worldMod)
-		for blockLine in worldMod:
-			lineCounter += 1
-					
-			# remove the last empty line
-			if blockLine != '':
-				coords, blockType = blockLine.split(':')
-				# blockTiype is the index in MATERIALS
-				blockType = int(blockType)
-				
-				#print main.MATERIALS
-				#print blockType
-				#print main.MATERIALS[blockType]
-				# convert the json list into tuple; json ONLY get lists but we need tuples
-				model.add_block( tuple(json.loads(coords)), blockType, False )
-			
-			if lineCounter > self.maxLineCounter:
-				lineCounterTotal += lineCounter
-				lineCounter = 0
-				self.printStuff(str(lineCounterTotal) + "/" + str(linesTotal))
-				
-				# just in case you dont want to exhaust memory!
-			if lineCounterTotal >= self.maxVoxels:
+		self.printStuff("loaded " + str(count) + " voxels")
+		self.printStuff('loading completed')
+	
+	def loadBinaryBlocks(self, model, fh, count, codec):
+		""" loads the compressed blocks of a binary save one by one
+		"""
+		start = time()
+		blockCount = int(numpy.fromfile(fh, dtype="<u4", count=1)[0])
+		table = numpy.fromfile(fh, dtype=BLOCK_ENTRY, count=blockCount)
+		voxelsTotal = 0
+		for blockVoxels, length in table.tolist():
+			if voxelsTotal >= self.maxVoxels:
 				break
-			
-		self.printStuff("loaded " + str(lineCounterTotal + lineCounter) + " voxels")
+			positions, materials = unpackBlock(fh.read(length), blockVoxels, codec)
+			# just in case you dont want to exhaust memory!
+			keep = self.maxVoxels - voxelsTotal
+			model.add_blocks(positions[:keep], materials[:keep])
+			voxelsTotal += min(blockVoxels, keep)
+			self.printStuff(str(voxelsTotal) + "/" + str(count))
+		
+		duration = max(time() - start, 1e-6)
+		self.printStuff("loaded " + str(voxelsTotal) + " voxels (" + codec + ") in %.2f s (%d voxels/s)" % (duration, voxelsTotal / duration))
+		self.printStuff('loading completed')
+	
+	def loadWorldText(self, model):
+		self.printStuff('start loading...') 
+		start = time()
+		fh = open(self.getSaveDest(), 'rb')
+		reader = fh
+		if fh.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+			# decompressed block by block while reading
+			reader = gzip.GzipFile(fileobj=fh, mode='rb')
+		fh.seek(0)
+		
+		voxelsTotal = 0
+		skippedLines = 0
+		rest = ''
+		while voxelsTotal < self.maxVoxels:
+			data = reader.read(TEXT_BLOCK_SIZE)
+			if not data:
+				break
+			# only whole lines, the rest goes in front of the next block
+			data = rest + data
+			lastLine = data.rfind('\n') + 1
+			rest = data[lastLine:]
+			added, skipped = self.addSaveLines(model, data[:lastLine], voxelsTotal)
+			voxelsTotal += added
+			skippedLines += skipped
+			self.printStuff(str(voxelsTotal) + " voxels, " + str(fh.tell()) + " bytes")
+		
+		if rest.strip() and voxelsTotal < self.maxVoxels:
+			# last line without newline
+			added, skipped = self.addSaveLines(model, rest + '\n', voxelsTotal)
+			voxelsTotal += added
+			skippedLines += skipped
+		reader.close()
+		fh.close()
+		if skippedLines:
+			self.printStuff("skipped " + str(skippedLines) + " lines that are neither [x, y, z] nor [x, y0, z, y1]")
+		
+		duration = max(time() - start, 1e-6)
+		self.printStuff("loaded " + str(voxelsTotal) + " voxels in %.2f s (%d voxels/s)" % (duration, voxelsTotal / duration))
 		self.printStuff('loading completed')
+	
+	def addSaveLines(self, model, data, voxelsTotal):
+		""" adds the blocks of whole text save lines to the model, at most
+		up to maxVoxels, returns the number of added voxels and of skipped lines
+		"""
+		voxels, runs, skipped = parseSaveLines(data)
+		# just in case you dont want to exhaust memory!
+		voxels = voxels[:self.maxVoxels - voxelsTotal]
+		model.add_blocks(voxels[:, :3], voxels[:, 3])
+		# heightMap columns [x, y0, z, y1] from dcm2save, y0 to y1 inclusive, they stay columns
+		runs = truncateRuns(runs, self.maxVoxels - voxelsTotal - len(voxels))
+		if len(runs) and not model.runs:
+			# blocks of the lines before the first column are not part of one
+			model.editedColumns.update(model.world.getColumns())
+		elif model.runs:
+			# single blocks next to the columns, the stl export writes them one by one
+			model.editedColumns.update(itertools.izip(voxels[:, 0].tolist(), voxels[:, 2].tolist()))
+		model.add_runs(runs)
+		return len(voxels) + int((runs[:, 3] - runs[:, 1] + 1).sum()), skipped
 		
 	def saveWorld(self, model):
+		""" F5, flushes the journal, the whole save is written in the
+		background if there is none yet or the journal is too big
+		"""
+		if self.journal is None and self.useJournal:
+			self.openJournal(model)
+		if self.journal is not None and self.hasSaveFile():
+			self.journal.sync()
+			self.printStuff("saved " + str(self.journal.records) + " edits in the journal")
+			model.notification = "saved"
+			self.notificationEnd = time() + 3
+			if self.journal.records <= self.compactRecords:
+				return
+		self.writeInBackground(model)
+	
+	def writeInBackground(self, model):
+		""" writes the whole world as a new save in the background, the
+		journal goes on in a new file meanwhile
+		"""
+		if self.isBusy(model):
+			return
+		dirty = set(model.dirtyChunks)
+		edits = model.unloadedEdits
+		if self.journal is not None:
+			self.journal.rotate()
+		
+		def done(success):
+			if not success:
+				# the records stay in <journal>.old, the next load replays them
+				model.dirtyChunks.update(dirty)
+				for chunk, chunkEdits in edits.iteritems():
+					chunkEdits.update(model.unloadedEdits.get(chunk, {}))
+					model.unloadedEdits[chunk] = chunkEdits
+				return
+			if self.saveFormat == "region":
+				# the table in this process does not know the new chunk places
+				firstRegion = self.region is None
+				self.region = regionFile.regionFile(self.getSaveDest())
+				self.loadedChunks.update(self.region.getChunks() if firstRegion else dirty.difference(edits))
+			if self.journal is None:
+				# edits from an older journal are part of the save now
+				self.removeJournal()
+			elif os.path.exists(self.getJournalPath() + ".old"):
+				os.remove(self.getJournalPath() + ".old")
+		
+		self.startTask("saving", self.writeWorld, model, done)
+		# after the start, the task writes the dirty chunks of its copy
+		model.dirtyChunks.clear()
+		model.unloadedEdits = {}
+	
+	def exportInBackground(self, model):
+		""" F6, the stl export in the background
+		"""
+		if self.isBusy(model):
+			return
+		if model.runs:
+			self.startTask("export", self.exportStlRuns, model)
+		else:
+			self.startTask("export", self.exportStlZ, model)
+	
+	def isBusy(self, model):
+		if self.task is None:
+			return False
+		model.notification = "wait, " + self.task["name"] + " is still running"
+		self.notificationEnd = time() + 3
+		return True
+	
+	def startTask(self, name, func, model, done=None):
+		""" runs func(model) in the background, in a forked process where
+		the OS can fork (it works on a copy on write view of the world as it
+		is now and does not slow down the editor), in a thread on a
+		worldSnapshot otherwise. The chunk files of an mmapWorld are mapped
+		shared, a forked process would see the edits made meanwhile, so it
+		always gets the thread and a copy on write mmapSnapshot.
+		done(success) is called in the editor when func finished, see
+		checkTask.
+		"""
+		if hasattr(os, "fork") and not isinstance(model.world, chunkWorld.mmapWorld):
+			queue = multiprocessing.Queue()
+			worker = multiprocessing.Process(target=self.runTask, args=(func, model, queue))
+		else:
+			queue = Queue.Queue()
+			worker = threading.Thread(target=self.runTask, args=(func, worldSnapshot(model), queue))
+		self.task = {"name":name, "worker":worker, "queue":queue, "done":done}
+		model.notification = name + "..."
+		self.notificationEnd = None
+		worker.start()
+	
+	def runTask(self, func, model, queue):
+		self.progress = queue
+		try:
+			func(model)
+		except (IOError, OSError, ValueError) as e:
+			queue.put(("failed", str(e)))
+		else:
+			queue.put(("done", ""))
+		finally:
+			self.progress = None
+			if isinstance(model, worldSnapshot):
+				model.release()
+	
+	def checkTask(self, model):
+		""" called every frame by the editor, shows the progress of the
+		background task in model.notification and finishes the task
+		"""
+		if self.task is None:
+			if self.notificationEnd is not None and time() > self.notificationEnd:
+				model.notification = ""
+				self.notificationEnd = None
+			return
+		
+		worker = self.task["worker"]
+		alive = worker.is_alive()
+		result = None
+		try:
+			while True:
+				kind, text = self.task["queue"].get_nowait()
+				if kind == "progress":
+					model.notification = self.task["name"] + ": " + text
+				else:
+					result = (kind, text)
+		except Queue.Empty:
+			pass
+		if result is None:
+			if alive:
+				return
+			result = ("failed", "the worker stopped")
+		
+		worker.join()
+		name = self.task["name"]
+		done = self.task["done"]
+		self.task = None
+		if result[0] == "done":
+			model.notification = name + " completed"
+		else:
+			model.notification = name + " failed: " + result[1]
+		self.printStuff(model.notification)
+		self.notificationEnd = time() + 3
+		if done is not None:
+			done(result[0] == "done")
+	
+	def waitForTask(self, model):
+		""" blocks until the background task is finished. The queue is read
+		while waiting, a process does not end before the messages it put
+		into its queue are read, a plain join could wait forever.
+		"""
+		while self.task is not None:
+			self.checkTask(model)
+			if self.task is not None:
+				self.task["worker"].join(0.05)
+	
+	def writeWorld(self, model):
+		""" writes the whole world in saveFormat, `model` may also be a worldSnapshot
+		"""
+		if self.saveFormat == "text":
+			self.saveWorldText(model)
+		elif self.saveFormat == "region":
+			self.saveWorldRegion(model)
+		else:
+			self.saveWorldBinary(model)
+	
+	def saveWorldRegion(self, model):
+		self.printStuff('start saving region...')
+		if self.region is None:
+			# not loaded from a region file, write all chunks
+			self.region = regionFile.regionFile(self.getSaveDest(), main.CHUNK_SIZE)
+			self.region.rewrite({})
+			chunks = set(model.world.getChunks())
+		else:
+			chunks = set(model.dirtyChunks)
+		
+		self.region.writeChunks(self.getChunkBlocks(model, chunks))
+		# the world has only the edits of the chunks that are not loaded
+		self.loadedChunks.update(chunks.difference(model.unloadedEdits))
+		model.dirtyChunks.clear()
+		model.unloadedEdits.clear()
+		self.printStuff('saved ' + str(len(chunks)) + ' chunks')
+		self.printStuff('saving completed')
+	
+	def saveWorldBinary(self, model):
+		self.printStuff('start saving binary...')
+		# positions as x, y, z columns, then the materials, chunk by chunk
+		chunks = list(model.world.iterChunks())
+		positions = numpy.concatenate([chunkPositions for chunkPositions, chunkMaterials in chunks] or [numpy.zeros((0, 3), dtype=numpy.int64)])
+		count = len(positions)
+		if count and (positions.min() < -32768 or positions.max() > 32767):
+			raise ValueError("blocks outside of the binary save range, use saveFormat=text")
+		
+		materials = numpy.concatenate([chunkMaterials for chunkPositions, chunkMaterials in chunks] or [numpy.zeros(0, dtype=numpy.int64)]).astype(numpy.uint8)
+		
+		# a new file first, a crash while writing must not destroy the old save
+		fh = open(self.getSaveDest() + ".part", 'wb')
+		if self.compression is None:
+			data = numpy.zeros(1, dtype=BINARY_HEADER.descr + getBinaryColumns(count).descr)
+			data["magic"] = BINARY_MAGIC
+			data["version"] = BINARY_VERSION
+			data["count"] = count
+			data["x"] = positions[:, 0]
+			data["y"] = positions[:, 1]
+			data["z"] = positions[:, 2]
+			data["material"] = materials
+			data.tofile(fh)
+		else:
+			self.writeBinaryBlocks(fh, positions, materials)
+		fh.close()
+		self.replaceSave()
+		self.printStuff('saving completed')
+	
+	def writeBinaryBlocks(self, fh, positions, materials):
+		""" writes the voxels sorted by position in compressed blocks,
+		the blocks are compressed in parallel
+		"""
+		header = numpy.zeros(1, dtype=BINARY_HEADER)
+		header["magic"] = BINARY_MAGIC
+		header["version"] = BINARY_VERSION
+		header["flags"] = CODECS[self.compression][0]
+		header["count"] = len(positions)
+		
+		order = numpy.lexsort((positions[:, 2], positions[:, 1], positions[:, 0]))
+		jobs = [(positions[order[start:start + COMPRESSED_BLOCK_VOXELS]], materials[order[start:start + COMPRESSED_BLOCK_VOXELS]], self.compression)
+			for start in xrange(0, len(order), COMPRESSED_BLOCK_VOXELS)]
+		pool = ThreadPool(multiprocessing.cpu_count())
+		try:
+			blocks = pool.map(packBlock, jobs)
+		finally:
+			pool.close()
+		
+		table = numpy.zeros(len(blocks), dtype=BLOCK_ENTRY)
+		table["count"] = [len(job[0]) for job in jobs]
+		table["length"] = [len(block) for block in blocks]
+		fh.write(header.tostring())
+		fh.write(numpy.array([len(blocks)], dtype="<u4").tostring())
+		fh.write(table.tostring())
+		for block in blocks:
+			fh.write(block)
+		self.printStuff("compressed " + str(len(positions) * 7) + " to " + str(int(table["length"].sum())) + " bytes (" + self.compression + ")")
+	
+	def saveWorldText(self, model):
 		self.printStuff('start saving...')
-		fh = open(self.getSaveDest(), 'w')
+		if self.compression is None:
+			fh = open(self.getSaveDest() + ".part", 'w')
+		else:
+			fh = gzip.open(self.getSaveDest() + ".part", 'wb', 6)
 		
 		# build a string to save it in one action
 		worldString = ''
@@ -90,7 +721,14 @@ class saveModule(object):
 
 		fh.write(worldString)
 		fh.close()
+		self.replaceSave()
 		self.printStuff('saving completed')
+	
+	def replaceSave(self):
+		""" replaces the save with the completely written <save>.part,
+		there is a complete save on the disk at any time
+		"""
+		regionFile.replaceFile(self.getSaveDest() + ".part", self.getSaveDest())
 
 	def exportStl(self, model):
 		self.printStuff('start export stl...')
@@ -160,7 +798,12 @@ class saveModule(object):
 		#collectedBlocks = set()
 		collectedBlocks = {}
 		zTubes =  {}
+		lineCounter = 0
+		linesTotal = len(model.shown)
 		for visBlock in model.shown:
+			lineCounter += 1
+			if lineCounter % self.maxLineCounter == 0:
+				self.printStuff(str(lineCounter) + "/" + str(linesTotal))
 			if not visBlock in collectedBlocks:
 				x = None
 				y = None
@@ -192,7 +835,29 @@ class saveModule(object):
 		writer.close()
 		self.printStuff('export stl completed')
 		
-	def getCubeFaces(self, x=0, y=0, z=0, zTop=0):
+	def exportStlRuns(self, model):
+		""" export for worlds loaded from heightMap columns (model.runs):
+		every column is written as one box instead of one cube per voxel,
+		only the columns changed in the editor are read from the world
+		"""
+		self.printStuff('start export stl runs...')
+		fh = open(self.getSaveDest() + '.stl', 'wb')
+		writer = stlWriter.Binary_STL_Writer(fh)
+		
+		edited = model.editedColumns
+		for runs in model.runs:
+			for x, y0, z, y1, blockType in runs.tolist():
+				if not (x, z) in edited:
+					writer.add_faces(self.getCubeFaces(x, y0, z, yTop=y1 - y0))
+		
+		# split where blocks were removed, blocks added in the editor
+		for x, y0, z, y1 in model.world.getColumnRuns(edited):
+			writer.add_faces(self.getCubeFaces(x, y0, z, yTop=y1 - y0))
+		
+		writer.close()
+		self.printStuff('export stl completed')
+		
+	def getCubeFaces(self, x=0, y=0, z=0, zTop=0, yTop=0):
 		# cube size
 		s = 1.0
 		# cube corner points
@@ -208,15 +873,16 @@ class saveModule(object):
 
 		# rotate X
 		# by: derf
+		# zTop stretches the cube along z, yTop along y
 		ar = [x, -z, y]
 		p1 = (0+ar[0], 0+ar[1], 0+ar[2])
-		p2 = (0+ar[0], 0+ar[1], s+ar[2])
+		p2 = (0+ar[0], 0+ar[1], s+ar[2]+yTop)
 		p3 = (0+ar[0], s+ar[1]-zTop, 0+ar[2])
-		p4 = (0+ar[0], s+ar[1]-zTop, s+ar[2])
+		p4 = (0+ar[0], s+ar[1]-zTop, s+ar[2]+yTop)
 		p5 = (s+ar[0], 0+ar[1], 0+ar[2])
-		p6 = (s+ar[0], 0+ar[1], s+ar[2])
+		p6 = (s+ar[0], 0+ar[1], s+ar[2]+yTop)
 		p7 = (s+ar[0], s+ar[1]-zTop, 0+ar[2])
-		p8 = (s+ar[0], s+ar[1]-zTop, s+ar[2])
+		p8 = (s+ar[0], s+ar[1]-zTop, s+ar[2]+yTop)
 
 		# define the 6 cube faces
 		# faces just lists of 3 or 4 vertices
@@ -0,0 +1,133 @@
+import numpy
+
+# one line per voxel in the save file: [y, z, x]:material
+VOXEL_LINE = "[%d, %d, %d]:%d\n"
+# one line per heightMap column: [y, z0, x, z1]:material, z0 to z1 inclusive
+RUN_LINE = "[%d, %d, %d, %d]:%d\n"
+
+
+class thresholdEngine(object):
+	""" Converts gray value slices into voxels with numpy array operations.
+
+	Every method works on a whole slice (or a whole stack) at once, the
+	produced lines are the same as the old pixel by pixel loop in
+	dcm2save.getFromPnm wrote.
+	"""
+	def __init__(self, minVal, maxVal, materialSwitch, materialMatrixL=99, heightMap=False, material=None, runs=True):
+		self.minVal = minVal
+		self.maxVal = maxVal
+		self.materialSwitch = materialSwitch
+		# max len of material index we can use
+		self.materialMatrixL = materialMatrixL
+		self.heightMap = heightMap
+		# a fixed material for all voxels instead of the materialSwitch steps
+		self.material = material
+		# write heightMap columns as one run line instead of one line per voxel
+		self.runs = runs
+
+	def getSliceValues(self, pixels, width, height):
+		""" Returns the x (row), y (column) and gray value of every pixel
+		in the order the old loop visited them.
+
+		The old loop walked x over the width and y over the height and read
+		index x * width + y of the flat pixel list, stopping a row when the
+		index ran out of the data. Non square images and multi sample pixels
+		are kept exactly that way so old and new saves stay identical.
+		"""
+		pixels = pixels.reshape(-1)
+		if width == height:
+			# the common case, just the flat pixel list
+			count = min(len(pixels), width * height)
+			index = numpy.arange(count)
+			return index // width, index % width, pixels[:count]
+
+		xs = numpy.repeat(numpy.arange(width), height)
+		ys = numpy.tile(numpy.arange(height), width)
+		index = xs * width + ys
+		inData = index < len(pixels)
+		return xs[inData], ys[inData], pixels[index[inData]]
+
+	def getGridValues(self, pixels, rows, columns, samples=1):
+		""" Returns the x (row), y (column) and gray value (first sample)
+		of every pixel of a (rows, columns) slice, row by row.
+
+		This is the walk of the DICOM pixel array, right for any slice
+		shape, getSliceValues keeps the old pnm indexing.
+		"""
+		image = pixels.reshape(rows, columns, samples)[:, :, 0]
+		return (numpy.repeat(numpy.arange(rows), columns), numpy.tile(numpy.arange(columns), rows),
+			image.reshape(-1))
+
+	def getMask(self, values):
+		""" Returns a bool array, True for every value between minVal and maxVal.
+		"""
+		return (values >= self.minVal) & (values <= self.maxVal)
+
+	def getMaterials(self, values):
+		""" Returns the material index (index in engine.MATERIALS) for
+		every accepted value.
+		"""
+		if self.material is not None:
+			return numpy.repeat(numpy.int64(self.material), len(values))
+		diff = values.astype(numpy.int64) - self.minVal
+		material = diff * self.materialSwitch
+		return numpy.where(material > self.materialMatrixL, self.materialMatrixL,
+			numpy.where(material < self.materialSwitch, diff, material))
+
+	def getVoxels(self, xs, ys, values, z):
+		""" Returns the x, y, z and material arrays of all voxels built
+		from the accepted pixels of one slice.
+
+		In heightMap mode every pixel becomes a column from 0 up to its
+		value above minVal instead of a single voxel at height `z`.
+		"""
+		materials = self.getMaterials(values)
+		if not self.heightMap:
+			return xs, ys, numpy.repeat(z, len(xs)), materials
+
+		heights = values.astype(numpy.int64) - self.minVal
+		starts = numpy.cumsum(heights) - heights
+		pixelIndex = numpy.repeat(numpy.arange(len(heights)), heights)
+		zs = numpy.arange(len(pixelIndex)) - starts[pixelIndex]
+		return xs[pixelIndex], ys[pixelIndex], zs, materials[pixelIndex]
+
+	def getRuns(self, xs, ys, values):
+		""" Returns the x, y, first z, last z and material arrays of the
+		heightMap columns built from the accepted pixels of one slice.
+		"""
+		heights = values.astype(numpy.int64) - self.minVal
+		isColumn = heights > 0
+		return (xs[isColumn], ys[isColumn], numpy.zeros(isColumn.sum(), dtype=numpy.int64),
+			heights[isColumn] - 1, self.getMaterials(values[isColumn]))
+
+	def convertSlice(self, pixels, width, height, z):
+		""" Thresholds a whole slice, returns the gray values of all
+		pixels, the accepted mask and the voxels (see getVoxels).
+		"""
+		xs, ys, values = self.getSliceValues(pixels, width, height)
+		mask = self.getMask(values)
+		return values, mask, self.getVoxels(xs[mask], ys[mask], values[mask], z)
+
+	def formatSlice(self, xs, ys, values, z):
+		""" Returns the save file lines for the accepted pixels of one
+		slice, heightMap columns as runs if `runs` is set.
+		"""
+		if self.heightMap and self.runs:
+			return self.formatRuns(*self.getRuns(xs, ys, values))
+		return self.formatVoxels(*self.getVoxels(xs, ys, values, z))
+
+	def formatVoxels(self, xs, ys, zs, materials):
+		""" Returns the save file lines for the given voxels.
+		"""
+		if not len(xs):
+			return ""
+		columns = numpy.column_stack((ys, zs, xs, materials)).astype(numpy.int64)
+		return (VOXEL_LINE * len(columns)) % tuple(columns.ravel().tolist())
+
+	def formatRuns(self, xs, ys, z0s, z1s, materials):
+		""" Returns the save file lines for the given heightMap columns.
+		"""
+		if not len(xs):
+			return ""
+		columns = numpy.column_stack((ys, z0s, xs, z1s, materials)).astype(numpy.int64)
+		return (RUN_LINE * len(columns)) % tuple(columns.ravel().tolist())